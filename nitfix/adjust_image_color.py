@@ -2,22 +2,29 @@
 
 """Adjust Image Colors to remove differences in photographic conditions."""
 
+import argparse
 import multiprocessing
+from functools import partial
 from random import shuffle
 
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
-from PIL import Image
 from matplotlib import patches
 
 import lib.db as db
+import lib.envelope as envelope
+import lib.image_loader as loader
 import lib.image_util as i_util
 import lib.util as util
 from lib.util import ADJUSTED_DIR, EXEMPLAR, PROCESSES
 
+JPEG_QUALITY = 95
+FACTOR = 0.75  # Shrink the images by this much
+PAD = 75  # Pad the QR-Code bounding box by this many pixels
 
-def adjust_images():
+
+def adjust_images(preview=False):
     """Adjust image colors."""
     albums = get_albums()
 
@@ -25,8 +32,9 @@ def adjust_images():
         path = ADJUSTED_DIR / album[0]['album']
         path.mkdir(exist_ok=True)
 
+    adjust = partial(adjust_album, preview=preview)
     with multiprocessing.Pool(processes=PROCESSES) as pool:
-        results = [pool.apply_async(adjust_album, (a,)) for a in albums]
+        results = [pool.apply_async(adjust, (a,)) for a in albums]
         results = [r.get() for r in results]
 
     found = sum(r for r in results)
@@ -34,42 +42,36 @@ def adjust_images():
     print(f'Adjusted {found} / {total}')
 
 
-def adjust_album(album):
-    """Adjust one album of images."""
+def adjust_album(album, preview=False):
+    """
+    Adjust one album of images.
+
+    Write the adjusted images or, for a preview, the original and adjusted
+    images side by side.
+    """
     # Get exemplar image data
-    image = get_image(EXEMPLAR)
+    image = loader.get_image(EXEMPLAR, FACTOR, rotate=True)
     inner, outer = get_image_rectangles(image)
     target = get_average_envelope_colors(image, inner, outer)
 
+    output = output_2_up if preview else output_adjusted
+
     found = 0
     for photo in album:
         out_path = ADJUSTED_DIR / photo['album'] / photo['photo']
         if not out_path.exists():
-            path = util.PHOTOS / photo['image_file']
-            image = get_image(path)
-            found += output_2_up(image, target, out_path)
+            image = loader.get_image(photo['image_file'], FACTOR, rotate=True)
+            found += output(image, target, out_path, get_qr_box(photo))
     return found
 
 
-def get_image(path):
-    """Read in the image and rotate it if needed."""
-    original = Image.open(path)
-    transformed = original.resize((
-        int(original.size[0] * 0.75),
-        int(original.size[1] * 0.75)))
-
-    dir_name = str(path.parent)
-    if original.size[0] > original.size[1]:
-        if (dir_name.startswith('Tingshuang')
-            and dir_name != 'Tingshuang_US_nitfix_photos') \
-                or dir_name in (
-                'MO-DOE-nitfix_visit3', 'NY_DOE-nitfix_visit3',
-                'NY_DOE-nitfix_visit4', 'NY_DOE-nitfix_visit5'):
-            transformed = transformed.transpose(Image.ROTATE_90)
-        else:
-            transformed = transformed.transpose(Image.ROTATE_270)
-
-    return transformed
+def get_qr_box(photo):
+    """Get where ingest found the QR code in the shrunken & rotated image."""
+    if photo['bbox'] is None:
+        return None
+    return loader.transform_bbox(
+        photo['bbox'], photo['image_file'], photo['size'], FACTOR,
+        rotate=True)
 
 
 def get_albums():
@@ -77,12 +79,24 @@ def get_albums():
     step = 2000  # Basic set size
     photos = []
 
+    # Ingest saved where it found the QR code so we don't have to find it again
+    sql = """
+        SELECT image_file, sample_id, width, height, left, top, right, bottom
+          FROM images
+     LEFT JOIN image_qr_codes USING (image_file);
+        """
+
     with db.connect() as cxn:
-        cursor = cxn.execute('select * from images')
+        cursor = cxn.execute(sql)
         for image in cursor:
             path = util.PHOTOS / image[0]
             if path.exists():
-                photos.append({'image_file': image[0], 'sample_id': image[1]})
+                has_box = image[4] is not None
+                photos.append({
+                    'image_file': image[0],
+                    'sample_id': image[1],
+                    'size': image[2:4],
+                    'bbox': image[4:8] if has_box else None})
 
     shuffle(photos)
 
@@ -99,16 +113,6 @@ def get_albums():
     return albums
 
 
-def expand_bbox(bbox):
-    """Create a bigger box surrounding the inner one."""
-    pad = 75  # Pad the QR-Code bounding box by this many pixels
-    return (
-        min(bbox[0], bbox[2]) - pad,
-        min(bbox[1], bbox[3]) - pad,
-        max(bbox[0], bbox[2]) + pad,
-        max(bbox[1], bbox[3]) + pad)
-
-
 def draw_rectangle(ax, bbox, color):
     """A helper function for drawing boxes on images."""
     wide = abs(bbox[2] - bbox[0])
@@ -118,47 +122,54 @@ def draw_rectangle(ax, bbox, color):
     ax.add_patch(rect)
 
 
-def get_image_rectangles(image):
+def get_image_rectangles(image, inner=None):
     """Get the inner and outer rectangles around the QR-code."""
-    inner = i_util.locate_qr_code(image)
+    inner = inner if inner else i_util.locate_qr_code(image)
     if not inner:
         return None, None
-    outer = expand_bbox(inner)
+    outer = envelope.expand_box(inner, PAD)
     return inner, outer
 
 
 def get_average_envelope_colors(image, inner, outer):
-    """Get the average RGB Values"""
-    data = np.asarray(image, dtype='int64')
+    """Get the average RGB values of the envelope around the QR-code."""
+    tables = envelope.build_tables(image, outer)
+    return envelope.ring_stats(tables, inner, outer).mean
 
-    crop = data[inner[1]:inner[3], inner[0]:inner[2]]
-    inner_sum = crop.sum(axis=0).sum(axis=0)
-    inner_size = crop.size
 
-    crop = data[outer[1]:outer[3], outer[0]:outer[2]]
-    outer_sum = crop.sum(axis=0).sum(axis=0)
-    outer_size = crop.size
+def adjust_image(image, diff):
+    """
+    Adjust entire image based on the difference in envelope colors.
 
-    average = (outer_sum - inner_sum) / (outer_size - inner_size)
-    return average
+    Every possible value of a channel is adjusted once to build a lookup
+    table and PIL maps all of the pixels through it in one pass.
+    """
+    levels = np.arange(256, dtype='float32')
+    table = [np.clip(levels - d, 0.0, 255.0).astype(np.uint8) for d in diff]
+    return image.point(np.concatenate(table).tolist())
 
 
-def adjust_image(image, diff):
-    """Adjust entire image based on the difference in envelope colors."""
-    data = np.asarray(image, dtype='float32')
+def correct_image(image, target, inner=None):
+    """Adjust the image so its envelope color matches the target color."""
+    inner, outer = get_image_rectangles(image, inner)
+    if not inner:
+        return image, None, None
+    avg = get_average_envelope_colors(image, inner, outer)
+    return adjust_image(image, avg - target), inner, outer
 
-    data[:, :, 0] = np.clip(data[:, :, 0] - diff[0], 0.0, 255.0)
-    data[:, :, 1] = np.clip(data[:, :, 1] - diff[1], 0.0, 255.0)
-    data[:, :, 2] = np.clip(data[:, :, 2] - diff[2], 0.0, 255.0)
 
-    return Image.fromarray(data.astype(np.uint8))
+def output_adjusted(image, target, out_path, inner=None):
+    """Write the adjusted image to the output file."""
+    adjusted, inner, _ = correct_image(image, target, inner)
+    adjusted.save(out_path, quality=JPEG_QUALITY)
+    return 1 if inner else 0
 
 
-def output_2_up(image, target, out_path):
+def output_2_up(image, target, out_path, inner=None):
     """Write images to output file."""
     dpi = matplotlib.rcParams['figure.dpi']
 
-    inner, outer = get_image_rectangles(image)
+    adjusted, inner, outer = correct_image(image, target, inner)
 
     width, height = image.size
     fig_size = width / float(dpi), height / float(dpi)
@@ -166,16 +177,11 @@ def output_2_up(image, target, out_path):
     fig, axes = plt.subplots(
         ncols=2, figsize=fig_size, constrained_layout=True)
 
-    found = 1
+    found = 0
     if inner:
-        avg = get_average_envelope_colors(image, inner, outer)
-        diff = avg - target
+        found = 1
         draw_rectangle(axes[0], outer, 'blue')
         draw_rectangle(axes[0], inner, 'cyan')
-        adjusted = adjust_image(image, diff)
-    else:
-        found = 0
-        adjusted = image
 
     axes[0].imshow(image)
     axes[1].imshow(adjusted)
@@ -187,5 +193,16 @@ def output_2_up(image, target, out_path):
     return found
 
 
+def parse_args():
+    """Process command-line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--preview', action='store_true',
+        help="""Draw the original and adjusted images side by side with the
+            QR-code envelope marked. This is much slower.""")
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
-    adjust_images()
+    ARGS = parse_args()
+    adjust_images(preview=ARGS.preview)
@@ -6,6 +6,7 @@ import re
 import pandas as pd
 
 import lib.db as db
+import lib.sci_names as sci_names
 from lib.util import RAW_DATA, TEMP_DATA
 
 GREENNESS_IN_CSV = RAW_DATA / 'Greenness_data_update_4rafe.csv'
@@ -22,14 +23,19 @@ def attach_sample_ids():
         select * from taxonomy_ids where sci_name in singles;
         """
 
+    df['sci_name'] = df['file'].str.split('_').str[:2].str.join(' ')
+
     with db.connect() as cxn:
         map_df = pd.read_sql(sql, cxn)
+        matches = sci_names.best_matches(df['sci_name'], cxn)
 
     name_map = map_df.set_index('sci_name')['sample_id'].to_dict()
 
-    df['sci_name'] = df['file'].str.split('_').str[:2].str.join(' ')
-
-    df['sample_id'] = df['sci_name'].map(name_map)
+    # Only attach sample IDs for exact matches, fuzzy ones need a review
+    exact = matches.score == 1.0
+    df['sample_id'] = matches.sci_name.where(exact).map(name_map)
+    df['matched_name'] = matches.sci_name.where(~exact)
+    df['match_score'] = matches.score
 
     df.to_csv(GREENNESS_OUT_CSV, index=False)
 
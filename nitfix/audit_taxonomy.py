@@ -9,6 +9,7 @@ However, pure garbage is excised without an error record.
 import pandas as pd
 
 import lib.db as db
+import lib.sci_names as sci_names
 
 
 def clean_taxonomy():
@@ -21,6 +22,9 @@ def clean_taxonomy():
     drop_bad_genera(cxn)
     drop_errors(cxn)
 
+    # Only index the names of taxa that made it through the audit
+    sci_names.create_synonyms_table(cxn)
+
 
 def drop_errors(cxn):
     """Remove duplicate taxonomy ids.
@@ -68,7 +72,7 @@ def get_duplicate_sample_ids(taxonomy_ids):
 
 def create_taxonomy_errors_table(cxn, errors):
     """Create taxonomy table."""
-    errors.to_sql('taxonomy_errors', cxn, if_exists='replace')
+    db.load_table(cxn, 'taxonomy_errors', errors, index=True)
 
     cxn.execute("""
         CREATE UNIQUE INDEX IF NOT EXISTS
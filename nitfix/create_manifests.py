@@ -9,22 +9,19 @@ These expeditions tend to be ad hoc.
 """
 
 import datetime
-import os
+import multiprocessing
 import random
 import re
-import sqlite3
 import zipfile
-from os.path import basename, dirname
+from functools import partial
+from os.path import basename
 
 import pandas as pd
-from PIL import Image
 
 import lib.db as db
+import lib.image_loader as loader
 import lib.util as util
 
-CXN = db.connect()
-CXN.row_factory = sqlite3.Row
-
 # A simple regex for checking if a string is a valid UUID
 IS_UUID = re.compile(
     r""" \b [0-9a-f]{8} - [0-9a-f]{4} - [1-5][0-9a-f]{3}
@@ -35,30 +32,36 @@ IS_UUID = re.compile(
 MISSING = '<missing/>'
 
 
-def zip_images(images, image_dir, factor=0.75):
-    """Shrink and rotate images and then put them into a zip file."""
-    image_zip_dir = util.TEMP_DATA / image_dir
-    os.makedirs(image_zip_dir, exist_ok=True)
-
-    for _, image_file in images.image_file.iteritems():
-        print(image_file)
-        src = util.PHOTOS / image_file
-        dst = image_zip_dir / image_file.replace('/', '_')
-        original = Image.open(src)
-        transformed = original.resize((
-            int(original.size[0] * factor),
-            int(original.size[1] * factor)))
-        dir_name = dirname(image_file)
-        if original.size[0] > original.size[1]:
-            if (dir_name.startswith('Tingshuang')
-                and dir_name != 'Tingshuang_US_nitfix_photos') \
-                    or dir_name in (
-                    'MO-DOE-nitfix_visit3', 'NY_DOE-nitfix_visit3',
-                    'NY_DOE-nitfix_visit4', 'NY_DOE-nitfix_visit5'):
-                transformed = transformed.transpose(Image.ROTATE_90)
-            else:
-                transformed = transformed.transpose(Image.ROTATE_270)
-        transformed.save(dst)
+def zip_images(images, name, factor=0.75):
+    """
+    Shrink and rotate images and then put them into a zip file.
+
+    The images are shrunk and encoded in parallel and written to the zip file
+    in order as they arrive, along with the manifest. Nothing is written to
+    temporary files.
+    """
+    zip_path = util.TEMP_DATA / f'{name}.zip'
+    image_files = images.image_file.tolist()
+    encode = partial(encode_image, factor=factor)
+
+    with zipfile.ZipFile(zip_path, mode='w') as zippy, \
+            multiprocessing.Pool(processes=util.PROCESSES) as pool:
+        zippy.writestr(
+            f'{name}.csv',
+            images.to_csv(index=False),
+            compress_type=zipfile.ZIP_DEFLATED)
+        for arc_name, data in pool.imap(encode, image_files, chunksize=8):
+            zippy.writestr(arc_name, data)  # JPEGs are already compressed
+
+    print(f'{len(image_files)} images written to {zip_path}')
+
+    loader.prune_derived_images()
+
+
+def encode_image(image_file, factor):
+    """Shrink and rotate an image and return it as JPEG bytes."""
+    data = loader.get_image_jpeg(image_file, factor, rotate=True)
+    return image_file.replace('/', '_'), data
 
 
 def doe_nitfix():
@@ -69,7 +72,7 @@ def doe_nitfix():
             JOIN taxonomy_ids USING (sample_id)
            WHERE image_file LIKE 'DOE-nitfix_specimen_photos/%';
           """
-    images = pd.read_sql(sql, CXN)
+    images = pd.read_sql(sql, db.connect(readonly=True))
     images['manifest_file'] = images.image_file.str.replace('/', '_')
     images.to_csv(util.TEMP_DATA / 'doe_manifest.csv', index=False)
     zip_images(images, 'doe', factor=0.25)
@@ -85,7 +88,7 @@ def remaining_1_of_3():
       ORDER BY image_file
          LIMIT 2500;
         """
-    images = pd.read_sql(sql, CXN)
+    images = pd.read_sql(sql, db.connect(readonly=True))
     images['manifest_file'] = images.image_file.str.replace('/', '_')
     images.to_csv(util.TEMP_DATA / 'nitfix_remaining_1_of_3.csv', index=False)
     zip_images(images, 'nitfix_remaining_1_of_3')
@@ -101,7 +104,7 @@ def remaining_2_of_3():
       ORDER BY image_file
          LIMIT 2500 OFFSET 2500;
     """
-    images = pd.read_sql(sql, CXN)
+    images = pd.read_sql(sql, db.connect(readonly=True))
     images['manifest_file'] = images.image_file.str.replace('/', '_')
     images.to_csv(util.TEMP_DATA / 'nitfix_remaining_2_of_3.csv', index=False)
     zip_images(images, 'nitfix_remaining_2_of_3')
@@ -117,7 +120,7 @@ def remaining_3_of_3():
       ORDER BY image_file
            LIMIT 2500 OFFSET 5000;
       """
-    images = pd.read_sql(sql, CXN)
+    images = pd.read_sql(sql, db.connect(readonly=True))
     images['manifest_file'] = images.image_file.str.replace('/', '_')
     images.to_csv(util.TEMP_DATA / 'nitfix_remaining_3_of_3.csv', index=False)
     zip_images(images, 'nitfix_remaining_3_of_3')
@@ -133,7 +136,7 @@ def mobot_all():
             OR image_file LIKE 'MO-DOE-nitfix_visit3/%'
             OR image_file LIKE 'Tingshuang_MO_nitfix_photos/%';
         """
-    images = pd.read_sql(sql, CXN)
+    images = pd.read_sql(sql, db.connect(readonly=True))
     images['manifest_file'] = images.image_file.str.replace('/', '_')
     images.to_csv(util.TEMP_DATA / 'mobot_all_manifest.csv', index=False)
 
@@ -150,7 +153,7 @@ def nybg234():
             OR image_file LIKE 'NY_DOE-nitfix_visit3/%'
             OR image_file LIKE 'NY_DOE-nitfix_visit4/%';
         """
-    images = pd.read_sql(sql, CXN)
+    images = pd.read_sql(sql, db.connect(readonly=True))
 
     sql = """
         SELECT image_file FROM image_errors
@@ -158,7 +161,7 @@ def nybg234():
             OR image_file LIKE 'NY_DOE-nitfix_visit3/%'
             OR image_file LIKE 'NY_DOE-nitfix_visit4/%';
         """
-    errors = pd.read_sql(sql, CXN)
+    errors = pd.read_sql(sql, db.connect(readonly=True))
 
     images.to_csv(util.TEMP_DATA / 'nybg_manifest.csv', index=False)
     errors.to_csv(util.TEMP_DATA / 'nybg_manifest_missing.csv', index=False)
@@ -173,7 +176,7 @@ def cal_academy():
          WHERE image_file LIKE '%/CAS-DOE-nitfix_specimen_photos/%'
       ORDER BY image_file;
     """
-    images = pd.read_sql(sql, CXN)
+    images = pd.read_sql(sql, db.connect(readonly=True))
 
     images.image_file = images.image_file.str.extract(r'.*/(.*)', expand=False)
 
@@ -184,7 +187,7 @@ def cal_academy():
         SELECT image_file FROM image_errors
          WHERE image_file LIKE 'CAS-DOE-nitfix_specimen_photos/%';
         """
-    errors = pd.read_sql(sql, CXN)
+    errors = pd.read_sql(sql, db.connect(readonly=True))
     errors.image_file = errors.image_file.str.extract(
         r'.*/(.*)', expand=False)
 
@@ -205,10 +208,10 @@ def nfn_submitted():
     df1 = pd.read_csv(util.INTERIM_DATA / 'nitfix_remaining_1_of_3.csv')
     df2 = pd.read_csv(util.INTERIM_DATA / 'nitfix_remaining_2_of_3.csv')
     df3 = pd.read_csv(util.INTERIM_DATA / 'nitfix_remaining_3_of_3.csv')
-    df4 = pd.read_sql(sql, CXN)
+    df4 = pd.read_sql(sql, db.connect(readonly=True))
     df4['manifest_file'] = df4.image_file.str.replace('/', '_')
     all_ = pd.concat([df1, df2, df3, df4])
-    all_.to_sql('nfn_submitted', CXN, if_exists='replace', index=False)
+    db.load_table(db.connect(), 'nfn_submitted', all_)
 
 
 def missing_location():
@@ -222,7 +225,7 @@ def missing_location():
                               WHERE location = '')
       ORDER BY image_file;
         """
-    df = pd.read_sql(sql, CXN)
+    df = pd.read_sql(sql, db.connect(readonly=True))
     df['manifest_file'] = df.image_file.str.replace('/', '_')
     steps = list(range(0, df.shape[0], size))
     splits = [df.iloc[i:i + size, :] for i in steps]
@@ -243,7 +246,7 @@ def missing_country():
                               WHERE country = '')
       ORDER BY image_file;
         """
-    df = pd.read_sql(sql, CXN)
+    df = pd.read_sql(sql, db.connect(readonly=True))
     df['manifest_file'] = df.image_file.str.replace('/', '_')
     steps = list(range(0, df.shape[0], size))
     splits = [df.iloc[i:i + size, :] for i in steps]
@@ -265,7 +268,7 @@ def random_subset():
          WHERE image_file NOT LIKE 'missing_photos%'
       ORDER BY image_file;
       """
-    rows = list(CXN.execute(sql))
+    rows = list(db.connect(readonly=True).execute(sql))
     rows = random.sample(rows, sample_size)
     rows = [{'image_file': r[0], 'sample_id': r[1],
              'manifest_file': r[0].replace('/', '_')} for r in rows]
@@ -288,11 +291,9 @@ def get_genera(name, genera):
         """
     sql = sql.replace(',);', ');')  # Handle a single item tuple
 
-    cursor = CXN.execute(sql)
-    row = cursor.fetchone()
-    columns = row.keys()
-
-    rows = list(CXN.execute(sql))
+    cursor = db.connect(readonly=True).execute(sql)
+    columns = [d[0] for d in cursor.description]
+    rows = cursor.fetchall()
     name = f'{name}_{datetime.date.today().strftime("%Y-%m-%d")}'
 
     df = pd.DataFrame(rows, columns=columns)
@@ -308,7 +309,7 @@ def image_zip():
     There was s request to get the images for a specific set of samples. This
     isn't an actual expedition.
     """
-    cxn = db.connect()
+    cxn = db.connect(readonly=True)
 
     sample_ids = _get_sample_ids()
     images = []
@@ -316,10 +317,12 @@ def image_zip():
     for sample_id in sample_ids:
         if IS_UUID.search(sample_id):
             sql = """SELECT image_file FROM images WHERE sample_id = ?"""
+            key = util.normalize_uuid(sample_id) or sample_id
         else:
             sql = """SELECT image_file FROM pilot_data WHERE pilot_id = ?"""
+            key = sample_id
         cur = cxn.cursor()
-        cur.execute(sql, (sample_id,))
+        cur.execute(sql, (key,))
         row = cur.fetchone()
         images.append(row[0] if row else MISSING)
 
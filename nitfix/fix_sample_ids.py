@@ -56,7 +56,11 @@ def manual_corrections_table():
         'sampleID_in_MasterTax': 'good_sample_id',
     })
 
-    df.to_sql('manual_corrections', cxn, if_exists='replace', index=False)
+    # Match the UUID form used in the tables these corrections join to
+    for column in ['bad_sample_id', 'good_sample_id']:
+        df[column] = util.clean_uuids(df[column])
+
+    db.load_table(cxn, 'manual_corrections', df)
 
 
 def add_taxonomy_ids():
@@ -23,9 +23,12 @@ def ingest_corrales_data():
 
 def create_corrales_data_table(cxn, corrales):
     """Create corrales data table."""
-    corrales.to_sql('corrales_data', cxn, if_exists='replace', index=False)
+    db.load_table(cxn, 'corrales_data', corrales)
 
     cxn.executescript("""
+        UPDATE corrales_data
+           SET sample_id = NORMALIZE_UUID(sample_id)
+         WHERE IS_UUID(sample_id);
         CREATE INDEX IF NOT EXISTS
             corrales_data_corrales_id ON corrales_data (corrales_id);
         CREATE UNIQUE INDEX IF NOT EXISTS
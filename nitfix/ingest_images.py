@@ -1,11 +1,12 @@
 """Extract, transform, and load data related to the images."""
 
 import os
-from os.path import join
-import multiprocessing
-from collections import namedtuple
+from os.path import dirname, join
+import sqlite3
+from collections import Counter, defaultdict, deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from glob import glob
-from itertools import chain
 
 import pandas as pd
 
@@ -15,30 +16,48 @@ import lib.util as util
 
 Dimensions = namedtuple('Dimensions', 'width height')
 
-BATCH_SIZE = 100
+BATCH_SIZE = 100  # Commit scan results to the journal this many at a time
+IN_FLIGHT = 4 * util.PROCESSES  # Images handed to the workers at one time
+
+SCAN_COLUMNS = ['image_file', 'size', 'mtime_ns', 'hash']
+BOX_COLUMNS = ['left', 'top', 'right', 'bottom']
+QR_CODE_COLUMNS = ['image_file', 'stage', 'width', 'height'] + BOX_COLUMNS
+JOURNAL_COLUMNS = ['sample_id', 'msg'] + QR_CODE_COLUMNS
 
 
 def ingest_images():
     """Process image files."""
     cxn = db.connect()
+    create_scan_journal_table(cxn)
 
-    # Get a list of all images and split it into roughly equal batches.
-    # Then send each batch to a subprocess. The subprocess returns a list of
-    # successfully processed images and a list of images that errored which are
-    # both combined into their own dataframes.
+    # Only scan images that are new or have changed since the last run. The
+    # scan cache tells us which images are unchanged and which ones were only
+    # moved or renamed. Images in the journal were scanned by a run that did
+    # not finish.
     old_images, old_errors = get_old_images(cxn)
-    image_files = get_images_to_process(old_images, old_errors)
-    batches = [image_files[i:i + BATCH_SIZE]
-               for i in range(0, len(image_files), BATCH_SIZE)]
-
-    with multiprocessing.Pool(processes=util.PROCESSES) as pool:
-        results = [pool.apply_async(ingest_batch, (b, )) for b in batches]
-        results = [r.get() for r in results]
-
-    new_images = list(chain(*[batch[0] for batch in results]))
-    new_errors = list(chain(*[batch[1] for batch in results]))
-    new_images = pd.DataFrame(new_images)
-    new_errors = pd.DataFrame(new_errors)
+    old_scans = get_old_scans(cxn)
+    journal = get_scan_journal(cxn)
+    done = (set(old_images.image_file) | set(old_errors.image_file)
+            | set(journal.image_file))
+    scans = get_image_scans()
+    image_files, renames = get_images_to_process(scans, old_scans, done)
+    old_images = drop_stale_images(old_images, image_files, renames)
+    old_errors = drop_stale_images(old_errors, image_files, renames)
+    old_codes = drop_stale_images(get_old_qr_codes(cxn), image_files, renames)
+    priors = get_qr_priors(cxn)
+
+    # Scan the images in subprocesses and journal the results in batches as
+    # they arrive. If this run dies the next one picks up where it stopped.
+    batch = []
+    for result in scan_images(image_files, priors):
+        batch.append(result)
+        if len(batch) >= BATCH_SIZE:
+            journal_results(cxn, batch)
+            batch = []
+    journal_results(cxn, batch)
+
+    journal = get_scan_journal(cxn)
+    new_images, new_errors, new_codes = split_journal(journal)
 
     # Now finalize the image and error tables. Also handle any errors that can
     # only be caught when the batches are combined. In this case it's looking
@@ -54,26 +73,220 @@ def ingest_images():
 
     create_image_table(cxn, images)
     create_image_errors_table(cxn, errors)
+    create_image_scans_table(cxn, scans)
+    create_image_qr_codes_table(
+        cxn, pd.concat([old_codes, new_codes], ignore_index=True))
+    create_qr_priors_table(cxn, update_qr_priors(priors, new_codes))
+    clear_scan_journal(cxn)
+
+
+def scan_images(image_files, priors):
+    """
+    Scan images in subprocesses and yield each result as it arrives.
+
+    Only a few images are handed to the workers at a time so results do not
+    pile up in memory. If a worker dies, say from a zbar segfault, we restart
+    the pool and retry every image that was in flight by itself. An image that
+    kills its worker a second time is quarantined as an error.
+    """
+    queue = deque(image_files)
+    while queue:
+        in_flight = {}
+        try:
+            with ProcessPoolExecutor(max_workers=util.PROCESSES) as executor:
+                yield from stream_results(executor, queue, in_flight, priors)
+        except BrokenProcessPool:
+            for image_file in in_flight.values():
+                yield scan_alone(image_file, priors)
+
+
+def stream_results(executor, queue, in_flight, priors):
+    """Keep the workers busy and yield results in the order they finish."""
+    while queue or in_flight:
+        while queue and len(in_flight) < IN_FLIGHT:
+            future = executor.submit(scan_image, queue[0], priors)
+            in_flight[future] = queue.popleft()
+
+        finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in finished:
+            result = future.result()
+            del in_flight[future]
+            yield result
+
+
+def scan_alone(image_file, priors):
+    """Scan a suspect image in its own process."""
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        try:
+            return executor.submit(scan_image, image_file, priors).result()
+        except BrokenProcessPool:
+            return scan_error(
+                image_file, f'CRASHED: QR scanner crashed on {image_file}')
+
+
+def scan_image(image_file, priors):
+    """Scan one image for its QR code."""
+    try:
+        image = i_util.open_image(image_file)
+        prior = priors.get(dirname(image_file))
+        qr_code = i_util.find_qr_code(image, prior) if image else None
+    except Exception as err:  # pylint: disable=broad-except
+        return scan_error(image_file, f'ERROR: {err} in {image_file}')
+
+    if not qr_code:
+        return scan_error(
+            image_file, f'MISSING: QR code missing in {image_file}')
+
+    box = qr_code.bbox if qr_code.bbox else (None, None, None, None)
+    return dict(zip(
+        JOURNAL_COLUMNS,
+        (qr_code.value, None, image_file, qr_code.stage, *image.size, *box)))
+
+
+def scan_error(image_file, msg):
+    """Build a scan result for an image without a QR code."""
+    result = dict.fromkeys(JOURNAL_COLUMNS)
+    result['image_file'] = image_file
+    result['msg'] = msg
+    return result
+
+
+def create_scan_journal_table(cxn):
+    """Create the table that holds scan results until the run finishes."""
+    cxn.execute("""
+        CREATE TABLE IF NOT EXISTS image_scan_journal (
+            sample_id  TEXT,
+            msg        TEXT,
+            image_file TEXT PRIMARY KEY,
+            stage      TEXT,
+            width      INTEGER,
+            height     INTEGER,
+            left       INTEGER,
+            top        INTEGER,
+            right      INTEGER,
+            bottom     INTEGER);""")
+
+
+def journal_results(cxn, results):
+    """Commit a batch of scan results."""
+    sql = f"""
+        INSERT OR REPLACE INTO image_scan_journal ({','.join(JOURNAL_COLUMNS)})
+        VALUES ({','.join('?' * len(JOURNAL_COLUMNS))});"""
+    with cxn:
+        cxn.executemany(
+            sql, [tuple(r[c] for c in JOURNAL_COLUMNS) for r in results])
+
+
+def get_scan_journal(cxn):
+    """Get scan results that have not made it into the image tables."""
+    return pd.read_sql('SELECT * FROM image_scan_journal;', cxn)
+
+
+def clear_scan_journal(cxn):
+    """The scan results are in the image tables so remove them."""
+    with cxn:
+        cxn.execute('DELETE FROM image_scan_journal;')
+
+
+def split_journal(journal):
+    """Split the journal into new images, errors, and QR code locations."""
+    found = journal.sample_id.notna()
+
+    new_images = journal.loc[found, ['image_file', 'sample_id']].copy()
+    new_images['sample_id'] = util.clean_uuids(new_images.sample_id)
+
+    new_errors = journal.loc[~found, ['image_file', 'msg']].copy()
+    new_errors['ok'] = 0
+    new_errors['resolution'] = ''
+
+    new_codes = journal.loc[found, QR_CODE_COLUMNS]
+
+    return new_images, new_errors, new_codes
 
 
 def create_image_table(cxn, images):
     """Create images table."""
-    images.to_sql('images', cxn, if_exists='replace', index=False)
-
-    cxn.executescript("""
-        CREATE UNIQUE INDEX IF NOT EXISTS
-            images_sample_id ON images (sample_id);
-        CREATE UNIQUE INDEX IF NOT EXISTS
-            images_image_file ON images (image_file);
-        """)
+    db.load_table(
+        cxn, 'images', images,
+        schema={'image_file': 'TEXT', 'sample_id': 'TEXT'},
+        indexes=["""CREATE UNIQUE INDEX IF NOT EXISTS
+                        images_sample_id ON images (sample_id);""",
+                 """CREATE UNIQUE INDEX IF NOT EXISTS
+                        images_image_file ON images (image_file);"""])
 
 
 def create_image_errors_table(cxn, errors):
     """Create image errors table."""
-    errors.to_sql('image_errors', cxn, if_exists='replace', index=False)
-    cxn.execute("""
-        CREATE UNIQUE INDEX IF NOT EXISTS
-            image_errors_image_file ON image_errors (image_file);""")
+    db.load_table(
+        cxn, 'image_errors', errors,
+        schema={'image_file': 'TEXT', 'msg': 'TEXT', 'ok': 'INTEGER',
+                'resolution': 'TEXT'},
+        indexes=["""CREATE UNIQUE INDEX IF NOT EXISTS
+                        image_errors_image_file
+                        ON image_errors (image_file);"""])
+
+
+def create_image_scans_table(cxn, scans):
+    """Create the scan cache table."""
+    db.load_table(
+        cxn, 'image_scans', scans,
+        schema={'image_file': 'TEXT', 'size': 'INTEGER',
+                'mtime_ns': 'INTEGER', 'hash': 'TEXT'},
+        indexes=["""CREATE UNIQUE INDEX IF NOT EXISTS
+                        image_scans_image_file
+                        ON image_scans (image_file);"""])
+
+
+def create_image_qr_codes_table(cxn, qr_codes):
+    """Create the table of where the QR code is in each image."""
+    schema = {c: 'INTEGER' for c in QR_CODE_COLUMNS}
+    schema.update({'image_file': 'TEXT', 'stage': 'TEXT'})
+    db.load_table(
+        cxn, 'image_qr_codes', qr_codes,
+        schema=schema,
+        indexes=["""CREATE UNIQUE INDEX IF NOT EXISTS
+                        image_qr_codes_image_file
+                        ON image_qr_codes (image_file);"""])
+
+
+def create_qr_priors_table(cxn, priors):
+    """Create the table of where QR codes are found in each album."""
+    rows = [{'album': album, 'col': cell[0], 'row': cell[1], 'hits': hits}
+            for album, prior in priors.items()
+            for cell, hits in prior.items()]
+    priors = pd.DataFrame(rows, columns=['album', 'col', 'row', 'hits'])
+    db.load_table(
+        cxn, 'qr_priors', priors,
+        schema={'album': 'TEXT', 'col': 'INTEGER', 'row': 'INTEGER',
+                'hits': 'INTEGER'})
+
+
+def get_qr_priors(cxn):
+    """
+    Get where QR codes were found in each album.
+
+    Every album was photographed on one copy stand, so the QR code tends to
+    be in the same place in all of the album's photos. The sliding window
+    search uses this to look in the most likely places first.
+    """
+    priors = defaultdict(Counter)
+    try:
+        for album, col, row, hits in cxn.execute(
+                'SELECT album, col, row, hits FROM qr_priors;'):
+            priors[album][(col, row)] = hits
+    except sqlite3.OperationalError:
+        pass
+    return priors
+
+
+def update_qr_priors(priors, new_codes):
+    """Add the QR codes we just found to the album priors."""
+    new_codes = new_codes[new_codes.left.notna()]
+    boxes = new_codes[BOX_COLUMNS].astype(int).itertuples(
+        index=False, name=None)
+    for image_file, box in zip(new_codes.image_file, boxes):
+        i_util.add_to_prior(priors[dirname(image_file)], box)
+    return priors
 
 
 def get_old_images(cxn):
@@ -87,6 +300,7 @@ def get_old_images(cxn):
             util.normalize_file_name)
         old_errors.image_file = old_errors.image_file.apply(
             util.normalize_file_name)
+        old_images.sample_id = util.clean_uuids(old_images.sample_id)
     except pd.io.sql.DatabaseError:  # noqa
         old_images = pd.DataFrame(columns=['image_file', 'sample_id'])
         old_errors = pd.DataFrame(
@@ -94,6 +308,24 @@ def get_old_images(cxn):
     return old_images, old_errors
 
 
+def get_old_scans(cxn):
+    """Get the scan cache from the last run."""
+    try:
+        old_scans = pd.read_sql('SELECT * FROM image_scans;', cxn)
+    except pd.io.sql.DatabaseError:  # noqa
+        old_scans = pd.DataFrame(columns=SCAN_COLUMNS)
+    return old_scans
+
+
+def get_old_qr_codes(cxn):
+    """Get where the QR codes were found in images already in the database."""
+    try:
+        old_codes = pd.read_sql('SELECT * FROM image_qr_codes;', cxn)
+    except pd.io.sql.DatabaseError:  # noqa
+        old_codes = pd.DataFrame(columns=QR_CODE_COLUMNS)
+    return old_codes
+
+
 def find_duplicate_uuids(images):
     """
     Create error records for UUID duplicates.
@@ -117,38 +349,80 @@ def find_duplicate_uuids(images):
     return images, dupes
 
 
-def ingest_batch(image_batch):
-    """Ingest image batch."""
-    new_images = []
-    new_errors = []
+def get_image_scans():
+    """Get the size and modification time of every image file on disk."""
+    scans = []
+    for image_dir in util.IMAGE_DIRS:
+        pattern = os.fspath(util.PHOTOS / image_dir / '*.[Jj][Pp][Gg]')
+        for path in glob(pattern):
+            stat = os.stat(path)
+            scans.append({
+                'image_file': util.normalize_file_name(path),
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'hash': ''})
+    return pd.DataFrame(scans, columns=SCAN_COLUMNS)
 
-    for image_file in image_batch:
-        sample_id = i_util.qr_value(image_file)
-        if sample_id:
-            new_images.append({
-                'image_file': image_file,
-                'sample_id': sample_id})
-        else:
-            new_errors.append({
-                'image_file': image_file,
-                'msg': f'MISSING: QR code missing in {image_file}',
-                'ok': 0,
-                'resolution': ''})
 
-    return new_images, new_errors
+def get_images_to_process(scans, old_scans, done):
+    """
+    Get all image files that are new or have changed since the last scan.
 
+    An image is unchanged if its size and modification time match the scan
+    cache. Otherwise, we hash it. If the hash matches the cached hash then the
+    file was only touched. If it matches the hash of a cached file that is no
+    longer on disk then the file was moved or renamed, and we reuse the old
+    file's results. Everything else gets scanned for a QR code.
 
-def get_images_to_process(old_images, old_errors):
-    """Get all image file names not in the database."""
-    skip_images = set(old_images.image_file) | set(old_errors.image_file)
+    The scans dataframe is updated in place with the hashes. Done is the set
+    of images that already have results.
+    """
+    cache = {s.image_file: s for s in old_scans.itertuples()}
+    on_disk = set(scans.image_file)
+    moved = {s.hash: s.image_file for s in old_scans.itertuples()
+             if s.image_file not in on_disk and s.image_file in done}
 
     image_files = []
-    for image_dir in util.IMAGE_DIRS:
-        pattern = os.fspath(util.PHOTOS / image_dir / '*.[Jj][Pp][Gg]')
-        file_names = glob(pattern)
-        image_files += map(util.normalize_file_name, file_names)
-    image_files = [f for f in image_files if f not in skip_images]
-    return sorted(image_files)
+    renames = {}
+    for scan in scans.itertuples():
+        cached = cache.get(scan.image_file)
+        if cached is not None and cached.size == scan.size \
+                and cached.mtime_ns == scan.mtime_ns:
+            scans.at[scan.Index, 'hash'] = cached.hash
+            if scan.image_file in done:
+                continue
+
+        hash_ = util.fast_hash(util.PHOTOS / scan.image_file)
+        scans.at[scan.Index, 'hash'] = hash_
+
+        unchanged = cached is None or cached.hash == hash_
+        if scan.image_file in done and unchanged:
+            continue
+
+        if hash_ in moved:
+            renames[scan.image_file] = moved.pop(hash_)
+            continue
+
+        image_files.append(scan.image_file)
+
+    return sorted(image_files), renames
+
+
+def drop_stale_images(old_results, image_files, renames):
+    """
+    Remove results that are about to be replaced.
+
+    Images that will be rescanned lose their old results and moved images
+    get their old results under their new names.
+    """
+    stale = set(image_files) | set(renames.values())
+    old_names = {v: k for k, v in renames.items()}
+
+    moved = old_results[old_results.image_file.isin(old_names)].copy()
+    moved.image_file = moved.image_file.map(old_names)
+
+    old_results = old_results[~old_results.image_file.isin(stale)]
+    return pd.concat([old_results, moved], ignore_index=True)
 
 
 def resolve_errors(errors):
@@ -12,7 +12,7 @@ def ingest_loci_sheet(google_sheet):
     """Ingest one sequencing metadata sheet."""
     cxn = db.connect()
     seq_sheet = get_sequencing_sheet(google_sheet)
-    seq_sheet.to_sql('loci_assembled', cxn, if_exists='replace', index=False)
+    db.load_table(cxn, 'loci_assembled', seq_sheet)
 
 
 def get_sequencing_sheet(google_sheet):
@@ -31,5 +31,6 @@ def get_sequencing_sheet(google_sheet):
 
 
 if __name__ == '__main__':
+    google.sync_sheets(LOCI_SHEETS)
     for SHEET in LOCI_SHEETS:
         ingest_loci_sheet(SHEET)
@@ -4,6 +4,7 @@ import pandas as pd
 
 import lib.db as db
 import lib.google as google
+import lib.sci_names as sci_names
 import lib.util as util
 
 
@@ -20,13 +21,14 @@ def ingest_loci_data():
         names=['sci_name', 'its', 'atpb', 'matk', 'matr', 'rbcl'])
 
     loci.sci_name = loci.sci_name.str.split().str.join(' ')
+    loci['accepted_name'] = sci_names.resolve_names(loci.sci_name, cxn)
 
     create_genbank_loci_table(cxn, loci)
 
 
 def create_genbank_loci_table(cxn, loci):
     """Create Genbank loci data table."""
-    loci.to_sql('genbank_loci', cxn, if_exists='replace', index=False)
+    db.load_table(cxn, 'genbank_loci', loci)
 
     cxn.execute("""
         CREATE UNIQUE INDEX IF NOT EXISTS
@@ -46,6 +46,7 @@ def get_expedition(csv_path):
 
 def fixup_data(nfn):
     """Merge duplicate sample IDs into one record."""
+    nfn['sample_id'] = util.clean_uuids(nfn.sample_id)
     aggs = {c: agg_concat for c in nfn.columns}
     dup_ids = nfn.sample_id.duplicated(keep=False)
     dups = nfn.loc[dup_ids].groupby('sample_id').agg(aggs)
@@ -105,11 +106,11 @@ def get_collection_no(row):
 
 def create_nfn_table(cxn, nfn):
     """Create Notes from Nature data table."""
-    nfn.to_sql('nfn_data', cxn, if_exists='replace')
-
-    cxn.execute("""
-        CREATE UNIQUE INDEX nfn_data_sample_id ON nfn_data (sample_id);
-        """)
+    db.load_table(
+        cxn, 'nfn_data', nfn, index=True,
+        schema={'index': 'INTEGER', 'sample_id': 'TEXT'},
+        indexes=["""CREATE UNIQUE INDEX IF NOT EXISTS
+                        nfn_data_sample_id ON nfn_data (sample_id);"""])
 
 
 if __name__ == '__main__':
@@ -22,7 +22,7 @@ def ingest_non_fabales_data():
 
 def create_genbank_loci_table(cxn, data):
     """Create Genbank loci data table."""
-    data.to_sql('non_fabales_data', cxn, if_exists='replace', index=False)
+    db.load_table(cxn, 'non_fabales_data', data)
 
     cxn.execute("""
         CREATE UNIQUE INDEX IF NOT EXISTS
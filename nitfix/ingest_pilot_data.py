@@ -29,9 +29,12 @@ def ingest_pilot_data():
 
 def create_pilot_data_table(cxn, pilot):
     """Create pilot data table."""
-    pilot.to_sql('pilot_data', cxn, if_exists='replace', index=False)
+    db.load_table(cxn, 'pilot_data', pilot)
 
     cxn.executescript("""
+        UPDATE pilot_data
+           SET sample_id = NORMALIZE_UUID(sample_id)
+         WHERE IS_UUID(sample_id);
         CREATE UNIQUE INDEX IF NOT EXISTS
             pilot_data_pilot_id ON pilot_data (pilot_id);
         CREATE UNIQUE INDEX IF NOT EXISTS
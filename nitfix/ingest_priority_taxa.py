@@ -24,7 +24,7 @@ def ingest_priority_taxa_list():
 
 def create_priority_taxa_table(cxn, taxa):
     """Create the priority taxa table."""
-    taxa.to_sql('priority_taxa', cxn, if_exists='replace', index=False)
+    db.load_table(cxn, 'priority_taxa', taxa)
 
     cxn.execute("""
         CREATE UNIQUE INDEX IF NOT EXISTS
@@ -17,7 +17,7 @@ def ingest_reformatting_template(sheet):
     """Ingest one reformatting template."""
     cxn = db.connect()
     wells = get_reformatted_wells(sheet, NAMES)
-    wells.to_sql(sheet, cxn, if_exists='replace', index=False)
+    db.load_table(cxn, sheet, wells)
 
 
 def get_reformatted_wells(sheet, names):
@@ -28,7 +28,7 @@ def get_reformatted_wells(sheet, names):
     google.sheet_to_csv(sheet, csv_path)
 
     wells = pd.read_csv(csv_path, header=0, na_filter=False, names=names)
-    wells['sample_id'] = wells['sample_id'].str.lower()
+    wells['sample_id'] = util.clean_uuids(wells['sample_id'].str.lower())
     # wells = wells.drop_duplicates('sample_id', keep=False)
 
     return wells.loc[wells['source_plate'] != '', :].copy()
@@ -52,11 +52,11 @@ def merge_reformatting_templates():
 
     merged['rapid_dest'] = merged['dest_plate'] + '_' + merged['dest_well']
 
-    merged.to_sql(
-        'reformatting_templates', cxn, if_exists='replace', index=False)
+    db.load_table(cxn, 'reformatting_templates', merged)
 
 
 if __name__ == '__main__':
+    google.sync_sheets(util.REFORMATTING_TEMPLATE_SHEETS)
     for SHEET in util.REFORMATTING_TEMPLATE_SHEETS:
         ingest_reformatting_template(SHEET)
     merge_reformatting_templates()
@@ -1,14 +1,36 @@
 """Extract, transform, and load data related to the samples."""
 
 import csv
-import pandas as pd
+from itertools import islice
+import numpy as np
 import lib.db as db
 import lib.google as google
+import lib.plates as plates
 import lib.util as util
 
 
-COLUMNS = 12
-COL_END = 1 + COLUMNS + 1    # 1 Label column  + 12 plate columns + 1
+COL_END = 1 + plates.COLUMNS  # 1 Label column + 12 plate columns
+HEADER_ROWS = ['entry_date', 'local_id', 'rapid_plates', 'notes', 'results']
+BATCH_SIZE = 100  # Plates per batch written to the database
+
+SAMPLE_PLATES_SCHEMA = {
+    'plate_id': 'TEXT PRIMARY KEY',
+    'entry_date': 'TEXT',
+    'local_id': 'TEXT',
+    'local_no': 'TEXT',
+    'rapid_plates': 'TEXT',
+    'notes': 'TEXT',
+    'results': 'TEXT',
+}
+
+SAMPLE_WELLS_SCHEMA = {
+    'plate_id': 'TEXT',
+    'row': 'TEXT',
+    'col': 'INTEGER',
+    'sample_id': 'TEXT',
+    'well': 'TEXT',
+    'well_no': 'INTEGER',
+}
 
 
 def ingest_samples():
@@ -32,82 +54,119 @@ def ingest_samples():
     Method:
     1) We look for something in the plate_data column that is a UUID.
     2) We then take that row and the next n rows.
+
+    The plate header goes into the sample_plates table and the wells with a
+    sample ID go into sample_wells. They are written in batches as the sheet
+    is read.
     """
     csv_path = util.TEMP_DATA / 'sample_plates.csv'
     google.sheet_to_csv(util.SAMPLE_PLATES_SHEET, csv_path)
 
-    sample_wells = []
+    plate_rows = read_plates(csv_path)
+    write_to_db(plate_batches(plate_rows))
+
+
+def read_plates(csv_path):
+    """Yield each plate's header and its plate rows as they are read."""
+    seen = set()
 
     with open(csv_path, newline='') as csv_file:
         reader = csv.reader(csv_file)
         for csv_row in reader:
-            if util.is_uuid(csv_row[0]):
-                header = build_headers(csv_row, reader)
-                build_wells(header, reader, sample_wells)
-
-    sample_wells = pd.DataFrame(sample_wells)
-
-    write_to_db(sample_wells)
-
-
-def build_headers(csv_row, reader):
-    """Build the well record header data.
-
-    Plate header data is attached to every sample well record.
-    """
-    header = {'plate_id': csv_row[0].strip()}
-
-    csv_row = next(reader)
-    header['entry_date'] = csv_row[0]
-
-    csv_row = next(reader)
-    header['local_id'] = csv_row[0].strip()
-    header['local_no'] = util.build_local_no(csv_row[0])
-
-    csv_row = next(reader)
-    header['rapid_plates'] = csv_row[0]
-
-    csv_row = next(reader)
-    header['notes'] = csv_row[0]
-
-    csv_row = next(reader)
-    header['results'] = csv_row[0]
-
+            if not csv_row or not util.is_uuid(csv_row[0]):
+                continue
+
+            plate_id = csv_row[0].strip()
+            line = reader.line_num
+            if plate_id in seen:
+                raise ValueError(
+                    f'{csv_path} line {line}: Plate {plate_id} is repeated')
+            seen.add(plate_id)
+
+            rows = list(islice(reader, len(HEADER_ROWS) + len(plates.ROWS)))
+            if len(rows) < len(HEADER_ROWS) + len(plates.ROWS):
+                raise ValueError(
+                    f'{csv_path} line {line}: Plate {plate_id} is cut off')
+
+            header = build_header(
+                plate_id, [r[0] if r else '' for r in rows[:len(HEADER_ROWS)]])
+            if not util.LOCAL_ID.match(header['local_id']):
+                raise ValueError(
+                    f'{csv_path} line {line + 2}: Plate {plate_id} has a bad '
+                    f'local ID "{header["local_id"]}"')
+
+            for row, csv_row in zip(plates.ROWS, rows[len(HEADER_ROWS):]):
+                if len(csv_row) < COL_END:
+                    raise ValueError(
+                        f'{csv_path}: Plate {plate_id} row {row} only has '
+                        f'{len(csv_row)} columns')
+
+            yield header, rows[len(HEADER_ROWS):]
+
+
+def build_header(plate_id, values):
+    """Build the plate header from the first cell of each header row."""
+    header = {'plate_id': plate_id, **dict(zip(HEADER_ROWS, values))}
+    header['local_id'] = header['local_id'].strip()
+    header['local_no'] = util.build_local_no(header['local_id'])
     return header
 
 
-def build_wells(header, reader, sample_wells):
-    """Build a well record for each sample ID.
+def plate_batches(plate_rows, batch_size=BATCH_SIZE):
+    """
+    Turn plates into column batches for the sample_plates & sample_wells.
 
-    Plate header data is attached to every sample well record.
+    Yields (table, columns) pairs. The plate header is stored once per plate
+    and the wells link to it by plate_id.
     """
-    for r, row in enumerate('ABCDEFGH'):
-        csv_row = next(reader)
-
-        for col in range(1, COL_END):
-            sample_id = csv_row[col].strip()
-
-            if util.is_uuid(sample_id):
-                sample_well = {
-                    'row': row,
-                    'col': col,
-                    'sample_id': sample_id,
-                    'well': f'{row}{col:02d}',
-                    'well_no': (COLUMNS * r) + col,
-                }
-                sample_wells.append({**header, **sample_well})
-
-
-def write_to_db(sample_wells):
-    """Output the sample wells to the database."""
-    with db.connect() as cxn:
-        sample_wells.to_sql(
-            'sample_wells', cxn, if_exists='replace', index=False)
-
-        cxn.execute("""
-            CREATE UNIQUE INDEX IF NOT EXISTS
-                sample_wells_plate_id_well ON sample_wells (plate_id, well);
-            """)
+    headers, cells = [], []
+
+    for i, (header, rows) in enumerate(plate_rows, 1):
+        headers.append(header)
+        cells.append([r[1:COL_END] for r in rows])
+
+        if i % batch_size == 0:
+            yield from build_batch(headers, cells)
+            headers, cells = [], []
+
+    yield from build_batch(headers, cells)
+
+
+def build_batch(headers, cells):
+    """Build the column batches for a group of plates."""
+    yield 'sample_plates', {
+        c: [h[c] for h in headers] for c in SAMPLE_PLATES_SCHEMA}
+    yield 'sample_wells', build_wells([h['plate_id'] for h in headers], cells)
+
+
+def build_wells(plate_ids, cells):
+    """Lay out the plates' cells and keep the wells with a sample ID."""
+    layout = plates.PlateArray(plate_ids)
+    layout.values[:] = np.array(cells, dtype=object).reshape(
+        layout.values.shape)
+
+    wells = layout.to_frame('sample_id')
+    wells['sample_id'] = util.normalize_uuids(wells.sample_id)
+    wells = wells.dropna(subset=['sample_id'])
+
+    return {c: wells[c].tolist() for c in SAMPLE_WELLS_SCHEMA}
+
+
+def write_to_db(batches):
+    """Stream the plates and their wells into the database."""
+    db.stream_tables(
+        db.connect(),
+        {'sample_plates': SAMPLE_PLATES_SCHEMA,
+         'sample_wells': SAMPLE_WELLS_SCHEMA},
+        batches,
+        indexes=[
+            """CREATE UNIQUE INDEX IF NOT EXISTS
+                   sample_wells_plate_id_well
+                   ON sample_wells (plate_id, well);""",
+            """CREATE INDEX IF NOT EXISTS
+                   sample_wells_sample_id ON sample_wells (sample_id);""",
+            """CREATE INDEX IF NOT EXISTS
+                   sample_plates_local_no ON sample_plates (local_no);"""])
 
 
 if __name__ == '__main__':
@@ -11,7 +11,7 @@ def ingest_sample_sheet(google_sheet):
     """Ingest one sample sheet."""
     cxn = db.connect()
     sample_sheet = get_sample_sheet(google_sheet)
-    sample_sheet.to_sql(google_sheet, cxn, if_exists='replace', index=False)
+    db.load_table(cxn, google_sheet, sample_sheet)
 
 
 def get_sample_sheet(google_sheet):
@@ -28,6 +28,7 @@ def get_sample_sheet(google_sheet):
             'sample_code', 'sample_id', 'i5_barcode_seq', 'i7_barcode_seq',
             'seq_file', 'seq_cycle'])
 
+    sample_sheet['sample_id'] = util.clean_uuids(sample_sheet['sample_id'])
     return sample_sheet.loc[sample_sheet['sample_code'] != '', :]
 
 
@@ -43,10 +44,11 @@ def merge_sample_sheets():
         else:
             merged = merged.append(sheet, ignore_index=True)
 
-    merged.to_sql('sample_sheets', cxn, if_exists='replace', index=False)
+    db.load_table(cxn, 'sample_sheets', merged)
 
 
 if __name__ == '__main__':
+    google.sync_sheets(SAMPLE_SHEETS)
     for SHEET in SAMPLE_SHEETS:
         ingest_sample_sheet(SHEET)
     merge_sample_sheets()
@@ -11,7 +11,7 @@ def ingest_sequencing_sheet(google_sheet):
     """Ingest one sequencing metadata sheet."""
     cxn = db.connect()
     seq_sheet = get_sequencing_sheet(google_sheet)
-    seq_sheet.to_sql(google_sheet, cxn, if_exists='replace', index=False)
+    db.load_table(cxn, google_sheet, seq_sheet)
 
 
 def get_sequencing_sheet(google_sheet):
@@ -31,6 +31,7 @@ def get_sequencing_sheet(google_sheet):
             'loci_assembled', 'hit_genus', 'hit_species', 'sample_genus',
             'sample_species', 'result', 'taxon_id_action'])
 
+    seq_sheet['sample_id'] = util.clean_uuids(seq_sheet['sample_id'])
     return seq_sheet
 
 
@@ -46,11 +47,11 @@ def merge_sequencing_sheets():
         else:
             merged = merged.append(sheet, ignore_index=True)
 
-    merged.to_sql(
-        'sequencing_metadata', cxn, if_exists='replace', index=False)
+    db.load_table(cxn, 'sequencing_metadata', merged)
 
 
 if __name__ == '__main__':
+    google.sync_sheets(SEQ_METADATA_SHEETS)
     for SHEET in SEQ_METADATA_SHEETS:
         ingest_sequencing_sheet(SHEET)
     merge_sequencing_sheets()
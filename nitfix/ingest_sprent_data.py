@@ -38,7 +38,7 @@ def ingest_sprent_data():
 
 def create_sprent_table(cxn, data):
     """Create Genbank loci data table."""
-    data.to_sql('sprent_data', cxn, if_exists='replace', index=False)
+    db.load_table(cxn, 'sprent_data', data)
 
     cxn.execute("""
         CREATE UNIQUE INDEX IF NOT EXISTS
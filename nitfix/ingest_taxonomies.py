@@ -5,15 +5,19 @@ import lib.db as db
 import lib.util as util
 import lib.google as google
 
+TAXONOMY_SCHEMA = {c: 'TEXT' for c in [
+    'column_a', 'family', 'sci_name', 'authority', 'synonyms', 'sample_ids',
+    'provider_acronym', 'provider_id', 'quality_notes', 'genus']}
+
 
 def ingest_taxonomy(google_sheet):
     """Ingest data related to the taxonomy."""
     cxn = db.connect()
 
     taxonomy = get_taxonomy(google_sheet)
-    taxonomy = split_sample_ids(taxonomy)
+    taxonomy = clean_sample_ids(taxonomy)
 
-    taxonomy.to_sql(google_sheet, cxn, if_exists='replace', index=False)
+    db.load_table(cxn, google_sheet, taxonomy, schema=TAXONOMY_SCHEMA)
     create_taxon_ids_table(cxn, google_sheet, taxonomy)
 
 
@@ -38,113 +42,152 @@ def get_taxonomy(google_sheet):
     return taxonomy
 
 
-def split_sample_ids(taxonomy):
-    """Split the sample IDs so each one in a row has its own column."""
-    # Fix inconsistent sample IDs: Remove extra spaces and lower case them
+def clean_sample_ids(taxonomy):
+    """Fix inconsistent sample IDs: Remove extra spaces and lower case them."""
     taxonomy.sample_ids = (taxonomy.sample_ids.str.lower()
                            .str.split().str.join(' '))
-
-    split_ids = taxonomy.sample_ids.str.split(r'\s*[;,]\s*', expand=True)
-    id_cols = {i: f'sample_id_{i + 1}' for i in split_ids.columns}
-    split_ids = split_ids.rename(columns=id_cols)
-
-    taxonomy = pd.concat([taxonomy, split_ids], axis=1)
-
     return taxonomy
 
 
 def create_taxon_ids_table(cxn, table, taxonomy):
-    """Create a way to link sample IDs to the master taxonomy record."""
+    """
+    Create a way to link sample IDs to the master taxonomy record.
+
+    There is a row for every sample ID in a taxon's sample_ids field, no
+    matter how many there are. This is the only place the split sample IDs
+    are kept.
+    """
     table += '_ids'
 
-    columns = [c for c in taxonomy.columns if c.startswith('sample_id_')]
+    split_ids = taxonomy.sample_ids.str.split(r'\s*[;,]\s*')
+    taxonomy_ids = taxonomy[['sci_name']].assign(sample_id=split_ids)
+    taxonomy_ids = taxonomy_ids.explode('sample_id', ignore_index=True)
 
-    taxonomy_ids = taxonomy.melt(
-        id_vars='sci_name', value_vars=columns, value_name='sample_id')
     not_na = taxonomy_ids.sample_id.notna()
     not_blank = taxonomy_ids.sample_id != ''
-    taxonomy_ids = taxonomy_ids.loc[
-        not_na & not_blank, ['sci_name', 'sample_id']]
+    taxonomy_ids = taxonomy_ids.loc[not_na & not_blank, :].copy()
+
+    # Store UUIDs in one form so joins on sample_id don't need to clean them
+    taxonomy_ids['sample_id'] = util.clean_uuids(taxonomy_ids.sample_id)
 
-    taxonomy_ids.to_sql(table, cxn, if_exists='replace', index=False)
+    db.load_table(
+        cxn, table, taxonomy_ids,
+        schema={'sci_name': 'TEXT', 'sample_id': 'TEXT'})
 
 
-def merge_taxonomies():
+def merge_taxonomies(sheets=None):
     """
-    Merge Tingshuang taxonomy with the master taxonomy.
+    Merge the taxonomies in order, the first one has the highest priority.
 
     Note: The input taxonomies currently have duplicate scientific names so
-    we need to make sure we don't propagate them.
+    we need to make sure we don't propagate them. A scientific name comes
+    from the first row with it in the first taxonomy that has it. A sample
+    ID comes from the first taxonomy that has it. We keep all of that
+    taxonomy's rows for the sample ID so the audit can catch samples that
+    were given more than one name.
     """
+    sheets = sheets if sheets else list(util.TAXONOMY_SHEETS.values())
     cxn = db.connect()
 
-    # Create tables
-    tax_cols = db.get_columns(cxn, 'NitFixMasterTaxonomy')
-    tax_cols = ','.join(tax_cols)
-    id_cols = db.get_columns(cxn, 'NitFixMasterTaxonomy_ids')
-    id_cols = ','.join(id_cols)
+    tax_cols = []
+    for sheet in sheets:
+        columns = db.get_columns(cxn, sheet)
+        tax_cols += [c for c in columns if c not in tax_cols]
+
+    stack_sources(cxn, 'taxonomy_sources', sheets, tax_cols, 'sci_name')
+    stack_sources(
+        cxn, 'taxonomy_id_sources', [s + '_ids' for s in sheets],
+        ['sci_name', 'sample_id'], 'sample_id')
+
+    columns = ', '.join(f'"{c}"' for c in tax_cols)
+    db.query_to_table(
+        cxn, 'taxonomy', f"""
+            SELECT {columns}
+              FROM (SELECT *, ROW_NUMBER() OVER (
+                                  PARTITION BY sci_name
+                                  ORDER BY source, source_row) AS taxon_no
+                      FROM temp.taxonomy_sources)
+             WHERE taxon_no = 1
+          ORDER BY source, source_row""",
+        indexes=[
+            """CREATE INDEX IF NOT EXISTS
+                   taxonomy_sci_name ON taxonomy (sci_name);""",
+            """CREATE INDEX IF NOT EXISTS
+                   taxonomy_genus ON taxonomy (genus);""",
+            """CREATE INDEX IF NOT EXISTS
+                   taxonomy_family ON taxonomy (family);"""])
+
+    db.query_to_table(
+        cxn, 'taxonomy_ids', """
+            SELECT sci_name, sample_id
+              FROM (SELECT *, MIN(source) OVER (
+                                  PARTITION BY sample_id) AS first_source
+                      FROM temp.taxonomy_id_sources)
+             WHERE source = first_source
+          ORDER BY source, source_row""",
+        indexes=[
+            """CREATE INDEX IF NOT EXISTS
+                   taxonomy_ids_sci_name
+                   ON taxonomy_ids (sci_name, sample_id);""",
+            """CREATE INDEX IF NOT EXISTS
+                   taxonomy_ids_sample_id
+                   ON taxonomy_ids (sample_id, sci_name);"""])
+
+    print_merge_stats(cxn, sheets)
+
+
+def stack_sources(cxn, table, sources, columns, key):
+    """
+    Stack the source tables into one temporary table.
 
-    cxn.executescript(f"""
-        drop table if exists taxonomy;
-        drop table if exists taxonomy_ids;
-
-        create table taxonomy ({tax_cols});
-        create table taxonomy_ids ({id_cols});
-    """)
-
-    # SQL template for inserting into taxonomy & taxonomy_ids tables
-    sql = """
-        INSERT INTO taxonomy
-        SELECT *
-          FROM {0}
-         WHERE sci_name NOT IN (SELECT sci_name FROM taxonomy)
-           AND rowid IN (SELECT rowid
-                           FROM {0}
-                       GROUP BY sci_name
-                         HAVING MIN(rowid));
-
-        INSERT INTO taxonomy_ids
-        SELECT *
-          FROM {0}_ids
-         WHERE sample_id NOT IN (SELECT sample_id FROM taxonomy_ids);
-        """
-
-    # Add data from NitFixMasterTaxonomy
-    cxn.executescript(sql.format('NitFixMasterTaxonomy'))
-    cxn.commit()
-
-    # Add data from Tingshuang_NitFixMasterTaxonomy
-    cxn.executescript(sql.format('Tingshuang_NitFixMasterTaxonomy'))
-    cxn.commit()
-
-    # Create indices
-    cxn.executescript("""
-        CREATE INDEX IF NOT EXISTS
-            taxonomy_sci_name ON taxonomy (sci_name);
-
-        CREATE INDEX IF NOT EXISTS
-            taxonomy_genus ON taxonomy (genus);
-
-        CREATE INDEX IF NOT EXISTS
-            taxonomy_family ON taxonomy (family);
-        """)
+    Every row is tagged with which source it came from and where it was in
+    that source. Columns missing from a source are left empty.
+    """
+    selects = []
+    for i, source in enumerate(sources):
+        have = set(db.get_columns(cxn, source))
+        fields = ', '.join(
+            f'"{c}"' if c in have else f'NULL AS "{c}"' for c in columns)
+        selects.append(
+            f'SELECT {i} AS source, rowid AS source_row, {fields} '
+            f'FROM "{source}"')
 
-    for i in range(1, 6):
-        cxn.execute(f"""
-            CREATE INDEX IF NOT EXISTS
-                taxonomy_sample_id_{i} ON taxonomy (sample_id_{i});
+    cxn.executescript(f"""
+        DROP TABLE IF EXISTS temp.{table};
+        CREATE TEMP TABLE {table} AS {' UNION ALL '.join(selects)};
+        CREATE INDEX temp.{table}_{key}
+            ON {table} ({key}, source, source_row);
         """)
 
-    cxn.executescript(f"""
-        CREATE INDEX IF NOT EXISTS
-            taxonomy_ids_sci_name ON taxonomy_ids (sci_name);
 
-        CREATE INDEX IF NOT EXISTS
-            taxonomy_ids_sample_id ON taxonomy_ids (sample_id);
-        """)
+def print_merge_stats(cxn, sheets):
+    """Report what each taxonomy added to the merged tables."""
+    names = cxn.execute("""
+        SELECT source, COUNT(*), SUM(taxon_no = 1)
+          FROM (SELECT source, ROW_NUMBER() OVER (
+                                   PARTITION BY sci_name
+                                   ORDER BY source, source_row) AS taxon_no
+                  FROM temp.taxonomy_sources)
+      GROUP BY source;""").fetchall()
+    ids = dict((s, (n, k)) for s, n, k in cxn.execute("""
+        SELECT source, COUNT(*), SUM(source = first_source)
+          FROM (SELECT source, MIN(source) OVER (
+                                   PARTITION BY sample_id) AS first_source
+                  FROM temp.taxonomy_id_sources)
+      GROUP BY source;"""))
+
+    for source, count, kept in names:
+        id_count, id_kept = ids.get(source, (0, 0))
+        print(f'{sheets[source]}: kept {kept} of {count} taxa and '
+              f'{id_kept} of {id_count} sample IDs')
+
+    taxa = cxn.execute('SELECT COUNT(*) FROM taxonomy').fetchone()[0]
+    id_rows = cxn.execute('SELECT COUNT(*) FROM taxonomy_ids').fetchone()[0]
+    print(f'Merged taxonomy: {taxa} taxa and {id_rows} sample IDs')
 
 
 if __name__ == '__main__':
-    ingest_taxonomy(util.TAXONOMY_SHEETS['uf'])
-    ingest_taxonomy(util.TAXONOMY_SHEETS['tingshuang'])
+    google.sync_sheets(util.TAXONOMY_SHEETS.values())
+    for SHEET in util.TAXONOMY_SHEETS.values():
+        ingest_taxonomy(SHEET)
     merge_taxonomies()
@@ -2,6 +2,7 @@
 
 import pandas as pd
 import lib.db as db
+import lib.sci_names as sci_names
 import lib.util as util
 
 
@@ -13,18 +14,16 @@ def ingest_werner_data():
     cxn = db.connect()
 
     werner = read_werner_data()
-    taxonomy = read_taxon_data(cxn)
 
-    sci_names = taxonomy.sci_name.tolist()
-    is_sci_name = werner.sci_name.isin(sci_names)
-
-    synonyms = get_synonyms(taxonomy)
-    is_synonym = werner.sci_name.isin(synonyms)
-
-    update_it = ~is_sci_name & is_synonym
-
-    werner.loc[update_it, 'sci_name'] = \
-        werner.loc[update_it, 'sci_name'].apply(lambda x: synonyms[x])
+    # Use the taxonomy's name for exact matches and synonyms. Fuzzy matches
+    # are only suggestions so they go next to the name for review. When
+    # names collide keep the best match.
+    matches = sci_names.best_matches(werner.sci_name, cxn)
+    exact = matches.score == 1.0
+    werner['matched_name'] = matches.sci_name.where(~exact)
+    werner['match_score'] = matches.score
+    werner['sci_name'] = matches.sci_name.where(exact, werner.sci_name)
+    werner = werner.sort_values('match_score', ascending=False, kind='stable')
 
     dups = werner.sci_name.duplicated()
     werner = werner.loc[~dups, :]
@@ -37,8 +36,7 @@ def ingest_werner_data():
 
 def create_werner_data_table(cxn, werner):
     """Create Werner data table."""
-    werner.to_sql(
-        'nitfixwerneretal2014', cxn, if_exists='replace', index=False)
+    db.load_table(cxn, 'nitfixwerneretal2014', werner)
 
     cxn.execute("""
         CREATE UNIQUE INDEX IF NOT EXISTS
@@ -65,27 +63,5 @@ def read_werner_data():
     return werner[is_nfc]
 
 
-def read_taxon_data(cxn):
-    """Get the taxon data we need for making the synonyms."""
-    return pd.read_sql("SELECT sci_name, synonyms FROM taxonomy;", cxn)
-
-
-def get_synonyms(taxonomy):
-    """Extract synonyms from the Master Taxonomy."""
-    synonyms = taxonomy.synonyms.str.split(r'\s*[;,]\s*', expand=True)
-    taxa = taxonomy[['sci_name', 'synonyms']]
-
-    taxa = pd.concat([taxa, synonyms], axis=1)
-    synonyms = taxa.melt(
-        id_vars=['sci_name'],
-        value_vars=synonyms.columns,
-        value_name='synonym')
-
-    synonyms = synonyms[synonyms.synonym.notna()].drop('variable', axis=1)
-    synonyms = synonyms.set_index('synonym').sci_name.to_dict()
-
-    return synonyms
-
-
 if __name__ == '__main__':
     ingest_werner_data()
@@ -1,36 +1,264 @@
-"""SQL functions."""
+"""SQL functions.
 
+Connections are shared. Each thread in each process gets one connection per
+database and access mode, and it is reused for the life of the process. So
+the pragmas are only issued once and scripts that ask for a connection over
+and over don't keep opening the DB. Do not close a shared connection.
+"""
+
+import atexit
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
 from os.path import exists
 from pathlib import Path
-import sqlite3
-from .util import PROCESSED_DATA, is_uuid
+from .util import PROCESSED_DATA, is_uuid, normalize_uuid
 
 DB_NAME = 'nitfix.sqlite.db'
 
+# Set when the database is created, these change the DB file itself
+CREATE_PRAGMAS = [
+    f'PRAGMA page_size = {2**16}',
+    'PRAGMA journal_mode = WAL',
+]
+
+# Set on every connection
+TUNING_PRAGMAS = [
+    'PRAGMA busy_timeout = 10000',
+    f'PRAGMA mmap_size = {2**30}',
+    f'PRAGMA cache_size = -{2**18}',  # In KiB so this is 256 MiB
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA temp_store = MEMORY',
+]
+
+UNIQUE_INDEX = re.compile(r'\s*CREATE\s+UNIQUE\s', re.IGNORECASE)
+
+POOL = {}
+POOL_LOCK = threading.Lock()
+
+
+def connect(path=None, readonly=False):
+    """Get this thread's shared connection to the SQLite3 DB."""
+    path = db_path(path)
+    key = (os.getpid(), threading.get_ident(), path, readonly)
+
+    with POOL_LOCK:
+        cxn = POOL.get(key)
+        if cxn is None:
+            cxn = open_connection(path, readonly)
+            POOL[key] = cxn
+
+    return cxn
+
 
-def connect(path=None):
-    """Connect to the SQLite3 DB."""
+@contextmanager
+def session(path=None, readonly=False):
+    """Use a shared connection and commit when done or roll back on errors."""
+    cxn = connect(path, readonly)
+    try:
+        yield cxn
+    except BaseException:
+        cxn.rollback()
+        raise
+    else:
+        cxn.commit()
+
+
+def db_path(path=None):
+    """Get the path to the DB file."""
     if not path:
         path = PROCESSED_DATA
 
     if not exists(path):
         path = Path('..') / PROCESSED_DATA
 
-    path = str(path / DB_NAME)
+    return str(Path(path) / DB_NAME)
+
 
-    cxn = sqlite3.connect(path)
+def open_connection(path, readonly=False):
+    """Open a new connection to the DB and tune it."""
+    if readonly:
+        cxn = sqlite3.connect(
+            f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+    else:
+        cxn = sqlite3.connect(path, check_same_thread=False)
+        for pragma in CREATE_PRAGMAS:
+            cxn.execute(pragma)
 
-    cxn.execute("PRAGMA page_size = {}".format(2**16))
-    cxn.execute("PRAGMA busy_timeout = 10000")
-    cxn.execute("PRAGMA journal_mode = WAL")
+    for pragma in TUNING_PRAGMAS:
+        cxn.execute(pragma)
 
-    cxn.create_function('IS_UUID', 1, is_uuid)
+    # Deterministic functions can be used in indexes and the WHERE clauses
+    # of partial indexes and SQLite may call them only once per value
+    cxn.create_function('IS_UUID', 1, is_uuid, deterministic=True)
+    cxn.create_function(
+        'NORMALIZE_UUID', 1, normalize_uuid, deterministic=True)
     return cxn
 
 
+@atexit.register
+def close_all():
+    """Close this process's connections, uncommitted work is rolled back."""
+    with POOL_LOCK:
+        pid = os.getpid()
+        for key in [k for k in POOL if k[0] == pid]:
+            POOL.pop(key).close()
+
+
+def load_table(cxn, table, df, schema=None, indexes=None, index=False):
+    """
+    Replace a table with the data frame's rows.
+
+    The schema maps column names to SQL types, columns that are not in it
+    get a type from their dtype. See swap_tables() for the indexes.
+    """
+    schema = schema if schema else {}
+    df = df.reset_index() if index else df
+
+    columns = ', '.join(
+        f'"{c}" {schema.get(c, sql_type(df[c].dtype))}' for c in df.columns)
+    params = ', '.join('?' * len(df.columns))
+
+    def fill(staging):
+        cxn.execute(f'CREATE TABLE "{staging}" ({columns})')
+        cxn.executemany(
+            f'INSERT INTO "{staging}" VALUES ({params})', table_rows(df))
+
+    swap_table(cxn, table, fill, indexes)
+
+
+def query_to_table(cxn, table, sql, indexes=None):
+    """Replace a table with the results of a query."""
+    def fill(staging):
+        cxn.execute(f'CREATE TABLE "{staging}" AS {sql}')
+
+    swap_table(cxn, table, fill, indexes)
+
+
+def stream_tables(cxn, schemas, batches, indexes=None):
+    """
+    Replace tables with rows that arrive in batches.
+
+    The schemas map each table to its columns and their SQL types. Each batch
+    is a (table, columns) pair where the columns map a column name to a list
+    of values, so only one batch is in memory at a time. See swap_tables()
+    for the indexes.
+    """
+    def fill(staging):
+        for table, schema in schemas.items():
+            columns = ', '.join(f'"{c}" {t}' for c, t in schema.items())
+            cxn.execute(f'CREATE TABLE "{staging[table]}" ({columns})')
+
+        for table, batch in batches:
+            names = list(schemas[table])
+            params = ', '.join('?' * len(names))
+            cxn.executemany(
+                f'INSERT INTO "{staging[table]}" VALUES ({params})',
+                zip(*(batch[c] for c in names)))
+
+    swap_tables(cxn, list(schemas), fill, indexes)
+
+
+def swap_table(cxn, table, fill, indexes=None):
+    """Build one staging table and rename it over the old one."""
+    swap_tables(cxn, [table], lambda staging: fill(staging[table]), indexes)
+
+
+def swap_tables(cxn, tables, fill, indexes=None):
+    """
+    Build staging tables and rename them over the old ones.
+
+    The fill function is given a dict of each table's staging table name to
+    create and fill. It's all done in one transaction so readers see either
+    the old tables or the new ones. If the connection is already in a
+    transaction the swap becomes part of it and the caller commits it.
+
+    The indexes are CREATE INDEX statements for the new tables. Non-unique
+    indexes on the old tables that are not given are rebuilt if their
+    columns still exist. Old unique indexes are not rebuilt because the new
+    data may break them.
+    """
+    indexes = indexes if indexes else []
+    staging = {t: f'{t}__staging' for t in tables}
+
+    # Inside of a caller's transaction use a savepoint and leave committing
+    # or rolling back the caller's other writes to the caller
+    owner = not cxn.in_transaction
+    cxn.execute('BEGIN IMMEDIATE' if owner else 'SAVEPOINT swap_tables')
+    try:
+        old_indexes = []
+        for table in tables:
+            old_indexes += cxn.execute(
+                """SELECT name, sql FROM sqlite_master
+                    WHERE type = 'index' AND tbl_name = ?
+                      AND sql IS NOT NULL""",
+                (table,)).fetchall()
+            cxn.execute(f'DROP TABLE IF EXISTS "{staging[table]}"')
+
+        fill(staging)
+
+        for table in tables:
+            cxn.execute(f'DROP TABLE IF EXISTS "{table}"')
+            cxn.execute(
+                f'ALTER TABLE "{staging[table]}" RENAME TO "{table}"')
+
+        for sql in indexes:
+            cxn.execute(sql)
+        rebuild_indexes(cxn, old_indexes)
+    except BaseException:
+        if owner:
+            cxn.rollback()
+        else:
+            cxn.execute('ROLLBACK TO swap_tables')
+            cxn.execute('RELEASE swap_tables')
+        raise
+
+    if owner:
+        cxn.commit()
+    else:
+        cxn.execute('RELEASE swap_tables')
+
+
+def rebuild_indexes(cxn, old_indexes):
+    """Recreate indexes from the old table that the new one does not have."""
+    for name, sql in old_indexes:
+        if UNIQUE_INDEX.match(sql):
+            continue
+        exists_ = cxn.execute(
+            """SELECT 1 FROM sqlite_master
+                WHERE type = 'index' AND name = ?""",
+            (name,)).fetchone()
+        if exists_:
+            continue
+        try:
+            cxn.execute(sql)
+        except sqlite3.OperationalError:
+            pass  # The new table doesn't have the index's columns
+
+
+def sql_type(dtype):
+    """Get the SQLite column type for a data frame column's dtype."""
+    if dtype.kind in 'biu':
+        return 'INTEGER'
+    if dtype.kind == 'f':
+        return 'REAL'
+    return 'TEXT'
+
+
+def table_rows(df):
+    """Convert data frame rows into tuples that SQLite can bind."""
+    df = df.copy()
+    for column in df.columns:
+        if df[column].dtype.kind in 'mM':
+            df[column] = df[column].astype(str)
+    df = df.astype(object).where(df.notna(), None)
+    return df.itertuples(index=False, name=None)
+
+
 def get_columns(cxn, table):
     """Get a list of columns from a table"""
     sql = f'PRAGMA table_info({table});'
-    cxn.row_factory = sqlite3.Row
     columns = [r[1] for r in cxn.execute(sql)]
     return columns
@@ -0,0 +1,123 @@
+"""Color statistics for the envelope around a QR code.
+
+We only build summed-area tables for the region around the QR code, so we
+never need a 64-bit copy of the whole photo. After that, the sum and sum of
+squares for any rectangle in the region takes four lookups. This makes it
+cheap to compare rings of different sizes around the QR code.
+"""
+
+from collections import namedtuple
+import numpy as np
+
+# Per band statistics for a rectangle or a ring
+Stats = namedtuple('Stats', 'mean median variance count')
+
+# The region's pixels and its summed-area tables (with a leading zero row and
+# column) for the values and their squares. The bounds are the region before
+# it was clipped to the image, boxes must stay inside of them.
+Tables = namedtuple('Tables', 'region pixels sums squares bounds')
+
+
+def build_tables(image, region):
+    """Build summed-area tables for a region of the image."""
+    bounds = region
+    region = clip_box(region, image.size)
+    pixels = np.asarray(image.crop(region))
+    if pixels.ndim == 2:
+        pixels = pixels[:, :, np.newaxis]
+
+    values = pixels.astype('int64')
+    height, width, bands = values.shape
+
+    sums = np.zeros((height + 1, width + 1, bands), dtype='int64')
+    sums[1:, 1:] = values.cumsum(axis=0).cumsum(axis=1)
+
+    squares = np.zeros((height + 1, width + 1, bands), dtype='int64')
+    squares[1:, 1:] = (values * values).cumsum(axis=0).cumsum(axis=1)
+
+    return Tables(region, pixels, sums, squares, bounds)
+
+
+def rect_sums(tables, box):
+    """Get the pixel count, sums, and sums of squares for a rectangle."""
+    if not inside(box, tables.bounds):
+        raise ValueError(f'Box {box} is outside of the tables {tables.bounds}')
+    left, top, right, bottom = local_box(tables, box)
+    count = (right - left) * (bottom - top)
+
+    def lookup(table):
+        return (table[bottom, right] - table[top, right]
+                - table[bottom, left] + table[top, left])
+
+    return count, lookup(tables.sums), lookup(tables.squares)
+
+
+def ring_stats(tables, inner, outer):
+    """Get the color statistics for the ring between two rectangles."""
+    outer_count, outer_sums, outer_squares = rect_sums(tables, outer)
+    inner_count, inner_sums, inner_squares = rect_sums(tables, inner)
+
+    left, top, right, bottom = local_box(tables, outer)
+    mask = np.ones((bottom - top, right - left), dtype=bool)
+    i_left, i_top, i_right, i_bottom = local_box(tables, inner)
+    mask[max(0, i_top - top):max(0, i_bottom - top),
+         max(0, i_left - left):max(0, i_right - left)] = False
+    pixels = tables.pixels[top:bottom, left:right][mask]
+
+    return stats(
+        outer_count - inner_count,
+        outer_sums - inner_sums,
+        outer_squares - inner_squares,
+        pixels)
+
+
+def pad_stats(image, inner, pads):
+    """Get the color statistics for rings of several widths around a box."""
+    tables = build_tables(image, expand_box(inner, max(pads)))
+    return {p: ring_stats(tables, inner, expand_box(inner, p)) for p in pads}
+
+
+def stats(count, sums, squares, pixels):
+    """Calculate statistics from the sums and the pixels themselves."""
+    if not count:
+        return None
+    mean = sums / count
+    variance = squares / count - mean * mean
+    median = np.median(pixels, axis=0)
+    return Stats(mean, median, variance, count)
+
+
+def expand_box(box, pad):
+    """Create a bigger box surrounding the inner one."""
+    return (
+        min(box[0], box[2]) - pad,
+        min(box[1], box[3]) - pad,
+        max(box[0], box[2]) + pad,
+        max(box[1], box[3]) + pad)
+
+
+def inside(box, outer):
+    """Check that the box, in any corner order, is inside the outer box."""
+    box = expand_box(box, 0)
+    return (box[0] >= outer[0] and box[1] >= outer[1]
+            and box[2] <= outer[2] and box[3] <= outer[3])
+
+
+def clip_box(box, size):
+    """Keep the box inside of the image."""
+    return (
+        max(0, box[0]),
+        max(0, box[1]),
+        min(size[0], box[2]),
+        min(size[1], box[3]))
+
+
+def local_box(tables, box):
+    """Convert an image box to table coordinates clipped to the region."""
+    left, top = tables.region[:2]
+    width, height = tables.region[2] - left, tables.region[3] - top
+    return (
+        min(width, max(0, box[0] - left)),
+        min(height, max(0, box[1] - top)),
+        min(width, max(0, box[2] - left)),
+        min(height, max(0, box[3] - top)))
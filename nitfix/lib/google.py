@@ -1,13 +1,27 @@
 """Utilities for connecting to Google sheets."""
 
 import os
-from os.path import join, exists
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from os.path import join, exists, splitext
+from pathlib import Path
 import argparse
 import httplib2
 from apiclient import discovery         # pylint: disable=import-error
 from oauth2client import client         # pylint: disable=import-error
 from oauth2client import tools          # pylint: disable=import-error
 from oauth2client.file import Storage   # pylint: disable=import-error
+from . import snapshots
+from .util import TEMP_DATA
+
+THREADS = 8  # How many sheets to talk to Google about at once
+
+SERVICE = None  # Set this to a test double to run without Google
+LOCAL = threading.local()
+CREDENTIALS = None
+CREDENTIALS_LOCK = threading.Lock()
+SYNCED = set()  # The sheets already exported in this process
 
 
 def get_credentials():
@@ -32,27 +46,126 @@ def get_credentials():
     return credentials
 
 
-def sheet_download(sheet_name, csv_path, mime_type):
-    """Export the Google Sheet."""
-    http = get_credentials().authorize(httplib2.Http())
-    service = discovery.build('drive', 'v3', http=http)
+def get_service():
+    """
+    Get this thread's Google Drive service.
+
+    The service's HTTP connection isn't thread safe so each thread builds
+    its own, once. A test double set with use_service() is used instead by
+    every thread. When replaying a snapshot, that is used instead.
+    """
+    if SERVICE is None and snapshots.replay_name():
+        use_service(SnapshotDriveService(snapshots.replay_name()))
+    if SERVICE is not None:
+        return SERVICE
+    if not hasattr(LOCAL, 'service'):
+        http = get_shared_credentials().authorize(httplib2.Http())
+        LOCAL.service = discovery.build('drive', 'v3', http=http)
+    return LOCAL.service
+
 
-    files = service.files().list(
+def use_service(service):
+    """Use this Drive service, like a test double, instead of Google's."""
+    global SERVICE  # pylint: disable=global-statement
+    SERVICE = service
+
+
+def get_shared_credentials():
+    """Only get the credentials once, it may prompt the user."""
+    global CREDENTIALS  # pylint: disable=global-statement
+    with CREDENTIALS_LOCK:
+        if CREDENTIALS is None:
+            CREDENTIALS = get_credentials()
+    return CREDENTIALS
+
+
+def find_sheets(sheet_name):
+    """Get Google Sheets with the name, the most recently modified first."""
+    return get_service().files().list(
         q='name="{}" and mimeType="{}"'.format(
             sheet_name, 'application/vnd.google-apps.spreadsheet'),
+        fields='files(id,name,modifiedTime)',
         orderBy='modifiedTime desc,name').execute().get('files', [])
 
-    # if not files:
-    #     raise FileNotFoundError(f'Could not read Google sheet {sheet_name}')
 
-    data = service.files().export(
-        fileId=files[0]['id'], mimeType=mime_type).execute()
+def find_sheet(sheet_name):
+    """Get the most recently modified Google Sheet with the name."""
+    files = find_sheets(sheet_name)
+    if not files:
+        raise FileNotFoundError(f'Could not find Google sheet {sheet_name}')
+    return files[0]
+
+
+def sheet_modified_time(sheet_name):
+    """Get when the Google Sheet was last modified."""
+    return find_sheet(sheet_name)['modifiedTime']
+
+
+def sheet_modified_times(sheet_names):
+    """Get when each of the Google Sheets was last modified, concurrently."""
+    sheet_names = list(dict.fromkeys(sheet_names))
+    with ThreadPoolExecutor(max_workers=THREADS) as executor:
+        times = executor.map(sheet_modified_time, sheet_names)
+        return dict(zip(sheet_names, times))
+
+
+def sheet_download(sheet_name, csv_path, mime_type):
+    """
+    Export the Google Sheet if it changed since the last export.
+
+    The sheet's modified time is saved next to the exported file. If the
+    sheet has the same modified time now then the old export is still good.
+    """
+    csv_path = Path(csv_path)
+    key = (sheet_name, str(csv_path), mime_type)
+    if key in SYNCED:
+        return
+
+    sheet = find_sheet(sheet_name)
+    modified_path = csv_path.with_name(csv_path.name + '.modified')
+
+    if csv_path.exists() and modified_path.exists() \
+            and modified_path.read_text() == sheet['modifiedTime']:
+        SYNCED.add(key)
+        return
+
+    data = get_service().files().export(
+        fileId=sheet['id'], mimeType=mime_type).execute()
 
     if not data:
         raise FileNotFoundError(f'Could not read Google sheet {sheet_name}')
 
     with open(csv_path, 'wb') as csv_file:
         csv_file.write(data)
+    modified_path.write_text(sheet['modifiedTime'])
+    SYNCED.add(key)
+
+
+def sync_sheets(sheet_names):
+    """
+    Export the Google Sheets concurrently to their default CSV files.
+
+    Later calls to sheet_to_csv() for these sheets in this process won't
+    talk to Google again.
+    """
+    with ThreadPoolExecutor(max_workers=THREADS) as executor:
+        futures = [executor.submit(sheet_to_csv, s, csv_path(s))
+                   for s in sheet_names]
+        for future in futures:
+            future.result()
+
+
+def snapshot_sheets(sheet_names, name=None):
+    """Export the Google Sheets and save them as a snapshot."""
+    sync_sheets(sheet_names)
+    times = sheet_modified_times(sheet_names)
+    sheets = {s: (csv_path(s), times[s]) for s in sheet_names}
+    return snapshots.save_snapshot(sheets, name)
+
+
+def csv_path(sheet_name):
+    """Get the default place to put a Google Sheet's CSV export."""
+    return TEMP_DATA / f'{splitext(sheet_name)[0]}.csv'
 
 
 def sheet_to_csv(sheet_name, csv_path):
@@ -66,3 +179,83 @@ def sheet_to_excel(sheet_name, csv_path):
         sheet_name,
         csv_path,
         'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+
+class LocalDriveService:
+    """
+    A stand in for the Google Drive service that reads a local directory.
+
+    A sheet named X is the file X.csv in the directory and its modified time
+    is the file's. Only the calls used above are supported. Use it like:
+    use_service(LocalDriveService('some/dir')).
+    """
+
+    def __init__(self, directory):
+        """Serve the CSV files in this directory."""
+        self.directory = Path(directory)
+
+    def files(self):
+        """Mimic the Drive files resource."""
+        return self
+
+    def list(self, q, **_):
+        """Find the sheet named in the query."""
+        name = q.split('"')[1]
+        path = self.directory / f'{name}.csv'
+        files = []
+        if path.exists():
+            modified = datetime.fromtimestamp(
+                path.stat().st_mtime, tz=timezone.utc)
+            files.append({
+                'id': name, 'name': name,
+                'modifiedTime': modified.isoformat()})
+        return LocalRequest({'files': files})
+
+    def export(self, fileId, **_):  # pylint: disable=invalid-name
+        """Get the sheet's contents."""
+        return LocalRequest((self.directory / f'{fileId}.csv').read_bytes())
+
+
+class SnapshotDriveService:
+    """
+    A stand in for the Google Drive service that reads a sheet snapshot.
+
+    Only the calls used above are supported.
+    """
+
+    def __init__(self, name):
+        """Serve the sheets in this snapshot."""
+        self.sheets = snapshots.load_snapshot(name)
+
+    def files(self):
+        """Mimic the Drive files resource."""
+        return self
+
+    def list(self, q, **_):
+        """Find the sheet named in the query."""
+        name = q.split('"')[1]
+        sheet = self.sheets.get(name)
+        files = []
+        if sheet:
+            files.append({
+                'id': name, 'name': name,
+                'modifiedTime': sheet['modifiedTime']})
+        return LocalRequest({'files': files})
+
+    def export(self, fileId, mimeType, **_):  # pylint: disable=invalid-name
+        """Get the sheet's contents."""
+        if mimeType != 'text/csv':
+            raise ValueError(f'Snapshots only hold CSV exports: {mimeType}')
+        return LocalRequest(snapshots.load_object(self.sheets[fileId]['hash']))
+
+
+class LocalRequest:
+    """A stand in for a Google API request."""
+
+    def __init__(self, result):
+        """Hold the request's result."""
+        self.result = result
+
+    def execute(self):
+        """Return the result like a real request would."""
+        return self.result
@@ -0,0 +1,206 @@
+"""Load photos for all of the tools that use them.
+
+Every tool that reads a photo also shrinks it and turns it upright in the
+same way, so it is all done here. JPEGs are decoded at a reduced size when
+possible and recently used images are kept in memory.
+"""
+
+import hashlib
+import io
+import os
+from collections import OrderedDict
+from pathlib import Path
+from PIL import Image
+from .util import DERIVED_IMAGES, PHOTOS, fast_hash
+
+CACHE_BYTES = 2**28  # Keep about this many bytes of images in each process
+DERIVED_BYTES = 2**35  # Keep about this many bytes of derived images on disk
+
+# Landscape photos in these albums are turned counterclockwise, the rest of
+# them are turned clockwise
+ROTATE_90_ALBUMS = {
+    'MO-DOE-nitfix_visit3',
+    'NY_DOE-nitfix_visit3',
+    'NY_DOE-nitfix_visit4',
+    'NY_DOE-nitfix_visit5'}
+
+# Bump this when rotation() changes so old derived images aren't reused
+ROTATION_VERSION = 1
+
+CACHE = OrderedDict()
+CACHE_TOTAL = 0  # The bytes of all images in the cache
+
+
+def get_image(image_file, factor=1.0, rotate=False, cache=True):
+    """
+    Get a photo shrunk by the factor and turned upright if asked.
+
+    The image is shared via the cache so treat it as read only. Skip the
+    cache for images that will only be read once.
+    """
+    path = photo_path(image_file)
+    key = (str(path), factor, rotate)
+
+    if key in CACHE:
+        CACHE.move_to_end(key)
+        return CACHE[key]
+
+    if rotate:
+        image = get_image(path, factor, cache=False)
+        method = rotation(path.parent.name, image.size)
+        image = image.transpose(method) if method is not None else image
+    else:
+        full = CACHE.get((str(path), 1.0, False))
+        image = shrink(full, factor) if full else decode(path, factor)
+
+    if cache:
+        cache_image(key, image)
+    return image
+
+
+def get_image_jpeg(image_file, factor=1.0, rotate=False):
+    """
+    Get a photo shrunk by the factor and turned upright as JPEG bytes.
+
+    Derived images are kept on disk under a key built from the photo's
+    contents and how it was transformed. Repeated exports of the same photos
+    read the small derived JPEG and don't decode the original again.
+    """
+    path = photo_path(image_file)
+    derived = DERIVED_IMAGES / derived_name(path, factor, rotate)
+
+    if derived.exists():
+        os.utime(derived)  # The modification time marks the last use
+        return derived.read_bytes()
+
+    image = get_image(path, factor, rotate, cache=False)
+    with io.BytesIO() as buffer:
+        image.save(buffer, format='JPEG')
+        data = buffer.getvalue()
+
+    # Other processes may want the same image so write it atomically
+    derived.parent.mkdir(parents=True, exist_ok=True)
+    temp = derived.with_suffix(f'.{os.getpid()}.tmp')
+    temp.write_bytes(data)
+    os.replace(temp, derived)
+
+    return data
+
+
+def derived_name(path, factor, rotate):
+    """
+    Build the derived image's file name from its contents & transforms.
+
+    The modification time catches a photo that was replaced by another one
+    with the same size, head, and tail. The rotation is keyed on the rule
+    that applies to the album, so changing the rules gives new names.
+    """
+    rule = rotation(path.parent.name, (2, 1)) if rotate else None
+    stat = path.stat()
+    key = (f'{fast_hash(path)} {stat.st_mtime_ns} {factor} '
+           f'{rule} {ROTATION_VERSION}').encode()
+    key = hashlib.blake2b(key, digest_size=16).hexdigest()
+    return Path(key[:2]) / f'{key}.jpg'
+
+
+def prune_derived_images(limit=DERIVED_BYTES):
+    """Delete the least recently used derived images if there are too many."""
+    derived = []
+    for path in DERIVED_IMAGES.glob('*/*.jpg'):
+        try:
+            derived.append((path.stat(), path))
+        except FileNotFoundError:
+            pass  # Another process pruned it
+
+    total = sum(s.st_size for s, _ in derived)
+    for stat, path in sorted(derived, key=lambda d: d[0].st_mtime):
+        if total <= limit:
+            break
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        total -= stat.st_size
+
+
+def photo_path(image_file):
+    """
+    Get the path to a photo given its path or its name in the photos dir.
+
+    Relative names are always in the photos dir even if the same name
+    exists under the current directory.
+    """
+    path = Path(image_file)
+    if path.is_absolute() or path.parts[:len(PHOTOS.parts)] == PHOTOS.parts:
+        return path
+    return PHOTOS / path
+
+
+def decode(path, factor):
+    """Read the photo and let the JPEG decoder do most of the shrinking."""
+    with open(path, 'rb') as image_fh:
+        image = Image.open(image_fh)
+        size = scaled_size(image.size, factor)
+        if factor < 1.0:
+            image.draft(image.mode, size)
+        image.load()
+    return shrink(image, factor, size)
+
+
+def shrink(image, factor, size=None):
+    """Resize the image to the target size."""
+    size = size if size else scaled_size(image.size, factor)
+    return image.resize(size) if image.size != size else image
+
+
+def scaled_size(size, factor):
+    """Get the image size after shrinking it by the factor."""
+    return int(size[0] * factor), int(size[1] * factor)
+
+
+def rotation(album, size):
+    """Get how to turn a photo from an album so that it is upright."""
+    if size[0] <= size[1]:
+        return None
+    if (album.startswith('Tingshuang')
+            and album != 'Tingshuang_US_nitfix_photos') \
+            or album in ROTATE_90_ALBUMS:
+        return Image.ROTATE_90
+    return Image.ROTATE_270
+
+
+def transform_bbox(box, image_file, size, factor=1.0, rotate=False):
+    """
+    Move a box on the original photo to the same spot on a transformed copy.
+
+    The size is the original photo's size. The factor and rotate arguments
+    are the same ones given to get_image.
+    """
+    width, height = scaled_size(size, factor)
+    left, top, right, bottom = (int(c * factor) for c in box)
+
+    album = photo_path(image_file).parent.name
+    method = rotation(album, (width, height)) if rotate else None
+
+    if method == Image.ROTATE_90:
+        return top, width - right, bottom, width - left
+    if method == Image.ROTATE_270:
+        return height - bottom, left, height - top, right
+    return left, top, right, bottom
+
+
+def cache_image(key, image):
+    """Add the image to the cache and drop the oldest images if it's full."""
+    global CACHE_TOTAL  # pylint: disable=global-statement
+    if key in CACHE:
+        CACHE_TOTAL -= image_bytes(CACHE[key])
+    CACHE[key] = image
+    CACHE_TOTAL += image_bytes(image)
+    while len(CACHE) > 1 and CACHE_TOTAL > CACHE_BYTES:
+        _, dropped = CACHE.popitem(last=False)
+        CACHE_TOTAL -= image_bytes(dropped)
+
+
+def image_bytes(image):
+    """Get the approximate size of an image in memory."""
+    return image.width * image.height * len(image.getbands())
@@ -4,93 +4,198 @@ Particularly feature extraction.
 """
 
 from collections import namedtuple
-from PIL import Image, ImageFilter
-import zbarlight    # pylint: disable=import-error
-import zbar
-from .util import PHOTOS
+from functools import lru_cache
+import cv2
+import numpy as np
+from PIL import ImageFilter
+import zbar    # zbarlight does not get the position of the QR-Code
+from .image_loader import get_image
 
 
 Dimensions = namedtuple('Dimensions', 'width height')
 
+# A decoded QR code, the search stage that found it, and its bounding box in
+# image coordinates. The box is None when the stage distorts the image.
+QrCode = namedtuple('QrCode', 'value stage bbox')
 
-def qr_value(image_file):
+THUMBNAIL_SCALE = 4  # How much to shrink the image for the first pass
+CANDIDATE_PAD = 50   # Pad candidate regions by this many full sized pixels
+
+WINDOW = Dimensions(400, 400)  # Sliding window size
+STRIDE = Dimensions(200, 200)  # Sliding window step & the QR prior cell size
+
+
+def qr_value(image_file, prior=None):
     """Read and process image."""
+    qr_code = qr_scan(image_file, prior)
+    return qr_code.value if qr_code else None
+
+
+def qr_scan(image_file, prior=None):
+    """Read an image and search it for a QR code."""
     image = open_image(image_file)
-    return get_qr_code(image) if image else None
+    return find_qr_code(image, prior) if image else None
 
 
 def open_image(image_file):
     """Open an image."""
-    path = str(image_file)
-    path = image_file if '/' in path else PHOTOS / image_file
-    with open(path, 'rb') as image_fh:
-        try:
-            image = Image.open(image_fh)
-            image.load()
-        except OSError:
-            return None
-    return image
+    try:
+        return get_image(image_file, cache=False)
+    except OSError:
+        return None
+
+
+@lru_cache(maxsize=None)
+def get_scanner():
+    """Get this process's QR code scanner.
+
+    Scanners leak memory so we only build one per process.
+    """
+    return zbar.Scanner()
 
 
 def get_qr_code(image):
+    """Extract the QR code value from the image."""
+    qr_code = find_qr_code(image)
+    return qr_code.value if qr_code else None
+
+
+def find_qr_code(image, prior=None):
     """
-    Extract QR code from image.
+    Find the QR code in the image.
 
     Try various methods to find the QR code in the image. Starting from
-    quickest and moving to the most unlikely method.
+    quickest and moving to the most unlikely method. The first methods search
+    a shrunken copy of the image and only look at the full sized image where
+    the QR code probably is. The prior, if given, is where QR codes were
+    found in other photos from the same album.
     """
-    qr_code = zbarlight.scan_codes('qrcode', image)
+    gray = image.convert('L')
+    scanner = get_scanner()
+
+    qr_code = find_positioned_qr_code(gray, scanner, prior)
     if qr_code:
-        return qr_code[0].decode('utf-8')
+        return qr_code
+
+    qr_code = get_qr_code_by_rotation(gray, scanner)
+    if qr_code:
+        return qr_code
+
+    return get_qr_code_by_sharpening(gray, scanner)
+
+
+def find_positioned_qr_code(gray, scanner, prior=None):
+    """Find the QR code with methods that keep track of its position."""
+    thumbnail = gray.reduce(THUMBNAIL_SCALE)
 
-    qr_code = get_qr_code_using_slider(image)
+    qr_code = get_qr_code_from_thumbnail(thumbnail, scanner)
     if qr_code:
         return qr_code
 
-    qr_code = get_qr_code_by_rotation(image)
+    qr_code = get_qr_code_from_candidates(gray, thumbnail, scanner)
     if qr_code:
         return qr_code
 
-    return get_qr_code_by_sharpening(image)
+    found = scan(gray, scanner)
+    if found:
+        return QrCode(found[0], 'full', found[1])
 
+    return get_qr_code_using_slider(gray, scanner, prior)
+
+
+def get_qr_code_from_thumbnail(thumbnail, scanner):
+    """Try to decode a shrunken copy of the image."""
+    found = scan(thumbnail, scanner)
+    if found:
+        box = tuple(c * THUMBNAIL_SCALE for c in found[1])
+        return QrCode(found[0], 'thumbnail', box)
+    return None
+
+
+def get_qr_code_from_candidates(gray, thumbnail, scanner):
+    """Decode the full sized image only where the QR code may be."""
+    for region in find_candidate_regions(thumbnail, gray.size):
+        found = scan(gray.crop(region), scanner)
+        if found:
+            return QrCode(found[0], 'candidate', offset_bbox(found[1], region))
+    return None
 
-def get_qr_code_using_slider(image):
+
+def find_candidate_regions(thumbnail, image_size):
+    """
+    Find regions of the full sized image that may contain a QR code.
+
+    OpenCV will find the QR code's finder patterns in the thumbnail even when
+    the thumbnail is too coarse to decode.
+    """
+    found, points = cv2.QRCodeDetector().detect(np.asarray(thumbnail))
+    if not found or points is None:
+        return []
+
+    points = points.reshape(-1, 2) * THUMBNAIL_SCALE
+    width, height = image_size
+    region = (
+        max(0, int(points[:, 0].min()) - CANDIDATE_PAD),
+        max(0, int(points[:, 1].min()) - CANDIDATE_PAD),
+        min(width, int(points[:, 0].max()) + CANDIDATE_PAD),
+        min(height, int(points[:, 1].max()) + CANDIDATE_PAD))
+    return [region]
+
+
+def get_qr_code_using_slider(image, scanner, prior=None):
     """Try sliding a window over the image to search for the QR code."""
-    for slider in window_slider(image):
+    for slider in window_slider(image, prior=prior):
         cropped = image.crop(slider)
-        qr_code = zbarlight.scan_codes('qrcode', cropped)
-        if qr_code:
-            return qr_code[0].decode('utf-8')
+        found = scan(cropped, scanner)
+        if found:
+            return QrCode(found[0], 'slider', offset_bbox(found[1], slider))
     return None
 
 
-def get_qr_code_by_rotation(image):
+def get_qr_code_by_rotation(image, scanner):
     """Try rotating the image to find the QR code *sigh*."""
     for degrees in range(5, 85, 5):
         rotated = image.rotate(degrees)
-        qr_code = zbarlight.scan_codes('qrcode', rotated)
-        if qr_code:
-            return qr_code[0].decode('utf-8')
+        found = scan(rotated, scanner)
+        if found:
+            return QrCode(found[0], 'rotation', None)
     return None
 
 
-def get_qr_code_by_sharpening(image):
+def get_qr_code_by_sharpening(image, scanner):
     """Try to sharpen the image to find the QR code."""
     sharpened = image.filter(ImageFilter.SHARPEN)
-    qr_code = zbarlight.scan_codes('qrcode', sharpened)
-    if qr_code:
-        return qr_code[0].decode('utf-8')
+    found = scan(sharpened, scanner)
+    if found:
+        return QrCode(found[0], 'sharpening', found[1])
+    return None
+
+
+def scan(gray, scanner):
+    """Scan a grayscale image and return the QR code value and its box."""
+    results = [r for r in scanner.scan(np.asarray(gray))
+               if r.type == 'QR-Code']
+    if results:
+        return results[0].data.decode('utf-8'), bbox(results)
     return None
 
 
-def window_slider(image_size, window=None, stride=None):
+def window_slider(image_size, window=None, stride=None, prior=None):
     """
     Create slider window.
 
-    It helps with feature extraction by limiting the search area.
+    It helps with feature extraction by limiting the search area. If there is
+    a prior then the windows are returned from most to least likely to hold
+    the QR code, otherwise they are in raster order.
     """
-    window = window if window else Dimensions(400, 400)
-    stride = stride if stride else Dimensions(200, 200)
+    window = window if window else WINDOW
+    stride = stride if stride else STRIDE
+
+    if prior:
+        sliders = window_slider(image_size, window, stride)
+        yield from sorted(
+            sliders, key=lambda s: -window_score(s, prior, stride))
+        return
 
     for top in range(0, image_size.height, stride.height):
         bottom = top + window.height
@@ -105,37 +210,35 @@ def window_slider(image_size, window=None, stride=None):
             yield slider
 
 
-def locate_qr_code(image):
-    """Find the location of a QR code in the image."""
-    scanner = zbar.Scanner()  # Memory leaks somewhere, so be careful here
-    gray = image.convert('L')
+def window_score(slider, prior, stride):
+    """Count how many of the album's QR codes were centered in the window."""
+    return sum(hits for (col, row), hits in prior.items()
+               if slider[0] <= col * stride.width < slider[2]
+               and slider[1] <= row * stride.height < slider[3])
 
-    results = scanner.scan(gray)
-    if results:
-        return bbox(results)
 
-    results = locate_qr_code_using_slider(gray, scanner)
-    if results:
-        return results
+def add_to_prior(prior, box, stride=None):
+    """Record where a QR code was found in a photo album."""
+    stride = stride if stride else STRIDE
+    center_x = (box[0] + box[2]) // 2
+    center_y = (box[1] + box[3]) // 2
+    prior[(center_x // stride.width, center_y // stride.height)] += 1
 
-    return None
+
+def locate_qr_code(image, prior=None):
+    """Find the location of a QR code in the image."""
+    gray = image.convert('L')
+    qr_code = find_positioned_qr_code(gray, get_scanner(), prior)
+    return qr_code.bbox if qr_code else None
 
 
-def locate_qr_code_using_slider(image, scanner):
-    """Try sliding a window over the image to search for the QR code."""
-    for slider in window_slider(image):
-        cropped = image.crop(slider)
-        results = scanner.scan(cropped)
-        if results:
-            box = bbox(results)
-            # Box is relative to the window, we want the position in the image
-            box = (
-                box[0] + slider[0],
-                box[1] + slider[1],
-                box[2] + slider[0],
-                box[3] + slider[1])
-            return box
-    return None
+def offset_bbox(box, region):
+    """Box is relative to the region, we want the position in the image."""
+    return (
+        box[0] + region[0],
+        box[1] + region[1],
+        box[2] + region[0],
+        box[3] + region[1])
 
 
 def bbox(results):
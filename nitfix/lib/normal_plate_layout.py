@@ -1,23 +1,44 @@
 """Utilities used to ingest all 'normal plates' sent to Rapid."""
 
 import re
-from collections import defaultdict
+from functools import lru_cache
+import numpy as np
 import pandas as pd
-from .db import connect
-from .util import TEMP_DATA, is_uuid
+from .db import connect, load_table
+from .util import TEMP_DATA, normalize_uuids
 from .google import sheet_to_csv
+from .plates import parse_wells, well_cols, well_rows
+
+# Rapid rows that don't exactly match a sample plate row are aligned with
+# the most similar row using MinHash signatures of their sample IDs
+NUM_PERM = 32
+BAND_SIZE = 2
+MIN_OVERLAP = 0.5
+_RNG = np.random.default_rng(20190521)
+MINHASH_A = _RNG.integers(1, 2**63, NUM_PERM, dtype=np.uint64) | np.uint64(1)
+MINHASH_B = _RNG.integers(0, 2**63, NUM_PERM, dtype=np.uint64)
+
+# Column types for the plate layout tables, other columns are TEXT
+PLATE_LAYOUT_SCHEMA = {
+    'row_sort': 'INTEGER',
+    'col_sort': 'INTEGER',
+    'volume': 'REAL',
+    'concentration': 'REAL',
+    'total_dna': 'REAL',
+    'source_col': 'INTEGER',
+    'valid_uuid': 'INTEGER',
+}
 
 
 def ingest_normal_plate_layout(google_sheet):
     """Extract, transform, and load samples sent to Rapid."""
     print(google_sheet)
 
-    cxn = connect()
-
     rapid_wells = get_rapid_wells(google_sheet)
     rapid_wells = assign_plate_ids(rapid_wells)
 
-    rapid_wells.to_sql(google_sheet, cxn, if_exists='replace', index=False)
+    load_table(
+        connect(), google_sheet, rapid_wells, schema=PLATE_LAYOUT_SCHEMA)
 
 
 def get_rapid_wells(google_sheet):
@@ -46,12 +67,18 @@ def get_rapid_wells(google_sheet):
     source_well = re.compile(r'^[A-Za-z]+_\d+_P\d+_W(\w+)$')
     rapid_wells['source_well'] = rapid_wells.rapid_source.str.extract(
         source_well, expand=False)
-    rapid_wells['source_row'] = rapid_wells['source_well'].str[0]
-    rapid_wells['source_col'] = rapid_wells['source_well'].str[1:].astype(int)
+    wells = parse_wells(rapid_wells['source_well'])
+    rapid_wells['source_row'] = well_rows(wells)
+    rapid_wells['source_col'] = well_cols(wells)
 
     rapid_wells['plate_id'] = ''
     rapid_wells['well'] = ''
-    rapid_wells['sample_id'] = rapid_wells['sample_id'].str.strip()
+
+    # Validate the sample IDs once here so nothing downstream has to
+    uuids = normalize_uuids(rapid_wells['sample_id'])
+    rapid_wells['valid_uuid'] = uuids.notna()
+    rapid_wells['sample_id'] = uuids.fillna(
+        rapid_wells['sample_id'].str.strip())
 
     return rapid_wells
 
@@ -68,7 +95,7 @@ def merge_normal_plate_layouts(google_sheets, table):
         else:
             merged = merged.append(sheet, ignore_index=True)
 
-    merged.to_sql(table, cxn, if_exists='replace', index=False)
+    load_table(cxn, table, merged, schema=PLATE_LAYOUT_SCHEMA)
 
 
 def assign_plate_ids(rapid_wells):
@@ -79,93 +106,202 @@ def assign_plate_ids(rapid_wells):
     If the sample has been plated more then once we need to figure out which
     sample plate well the Rapid well actually points too.
     """
-    cxn = connect()
-    sample_ids = defaultdict(list)
+    sample_wells = get_sample_wells()
 
-    sql = """
-        SELECT sample_id, plate_id, well
-          FROM sample_wells
-         WHERE length(sample_id) >= 5;"""
+    plated = sample_wells.groupby('sample_id').sample_id.transform('size')
+    once = sample_wells.loc[plated == 1, :].set_index('sample_id')
+    plate_ids = rapid_wells.sample_id.map(once.plate_id)
+    wells = rapid_wells.sample_id.map(once.well)
 
-    for row in cxn.execute(sql):
-        sample_id, plate_id, well = row
-        sample_ids[sample_id].append((plate_id, well))
-
-    sample_wells = pd.read_sql('SELECT * FROM sample_wells;', cxn)
-    sample_prints = _get_sample_fingerprints(sample_wells)
-    rapid_prints = _get_rapid_fingerprints(rapid_wells)
+    found = plate_id_heuristics(rapid_wells, sample_wells, plate_ids.isna())
 
-    # Vectorizing this loop is more trouble than it's worth
-    for idx, rapid_well in rapid_wells.iterrows():
-        locations = sample_ids[rapid_well['sample_id']]
+    rapid_wells['plate_id'] = plate_ids.fillna(found.plate_id).fillna('')
+    rapid_wells['well'] = wells.fillna(found.well).fillna('')
 
-        if len(locations) == 1:
-            where = locations[0]
-        else:
-            where = plate_id_heuristics(
-                rapid_well, rapid_prints, sample_prints)
+    return rapid_wells
 
-        if where:
-            plate_id, well = where
-            rapid_wells.at[idx, 'plate_id'] = plate_id
-            rapid_wells.at[idx, 'well'] = well
 
-    return rapid_wells
+@lru_cache(maxsize=1)
+def get_sample_wells():
+    """Get the sample plate wells once for every sheet we ingest."""
+    cxn = connect(readonly=True)
+    return pd.read_sql(
+        'SELECT plate_id, row, col, well, sample_id FROM sample_wells;', cxn)
 
 
-def plate_id_heuristics(rapid_well, rapid_prints, sample_prints):
+def plate_id_heuristics(rapid_wells, sample_wells, unplaced):
     """
     Use the plate fingerprints to find the plate ID.
 
-    1) Find Rapid plate's fingerprint using the Rapid source_plate and
-    source_row. {(source_well, source_row) -> fingerprint}
+    1) Build each Rapid row's fingerprint using the Rapid source_plate and
+       source_row. The fingerprint is a hash of the row's sorted sample IDs.
 
-    2) Find the sample plate and row using the fingerprint.
-    {fingerprint -> {source_row's plate_id, row, list of sample_ids in order}}
+    2) Find the sample plate row with the same fingerprint. If there isn't
+       one, a mis-scanned or blank well for instance, use the sample plate
+       row that overlaps the Rapid row the most. See _align_rows().
 
-    3) Get the first sample_id in the row that matches the Rapid sample_id.
-       Use its index to get the column number.
-
-    4) Blank out the sample_id in the list of sample_ids so the next one will
-       be found when there are duplicate sample IDs in a row.
+    3) Join the Rapid well to the well in that row with the same sample_id.
+       When a sample ID is in a row more than once, the Nth Rapid well with
+       it gets the Nth sample well with it, counting from the left. Exact
+       matches claim their wells first and rows found by their overlap only
+       get the wells that are left.
 
     NOTE: that rows can be permuted between the samples and what is sent to
     Rapid, so we need to sort the fingerprints of sample IDs.
     """
-    rapid_key = (rapid_well['source_plate'], rapid_well['source_row'])
-    fingerprint = rapid_prints.get(rapid_key)
+    rapid_prints = _get_rapid_fingerprints(rapid_wells)
+    sample_prints = _get_sample_fingerprints(sample_wells)
 
-    if not fingerprint or not is_uuid(rapid_well['sample_id']):
-        return None
+    todo = rapid_wells.loc[unplaced & rapid_wells.valid_uuid.astype(bool),
+                           ['source_plate', 'source_row', 'sample_id']]
+    todo = todo.join(
+        rapid_prints, on=['source_plate', 'source_row'], how='inner')
 
-    sample_row = sample_prints.get(fingerprint)
-    if not sample_row:
-        print(rapid_key)
-        return None
+    sample_rows = sample_prints.reset_index()
+    unknown = ~todo.fingerprint.isin(sample_rows.fingerprint)
 
-    col = sample_row['sample_ids'].index(rapid_well['sample_id'])
+    exact = _claim_wells(todo.loc[~unknown, :], sample_prints)
+    if not unknown.any():
+        return exact
 
-    sample_row['sample_ids'][col] = ''
-    well = f"{sample_row['row']}{(col + 1):02d}"
-    return sample_row['plate_id'], well
+    rapid_rows = rapid_wells.loc[rapid_wells.valid_uuid.astype(bool), :]
+    rapid_rows = rapid_rows.join(
+        rapid_prints, on=['source_plate', 'source_row'], how='inner')
+    rapid_rows = rapid_rows.loc[
+        rapid_rows.fingerprint.isin(todo.loc[unknown, 'fingerprint']), :]
+    aligned = _align_rows(rapid_rows, sample_rows)
+    _report_alignments(todo.loc[unknown, :], aligned, sample_prints)
+
+    partial = todo.loc[unknown & todo.fingerprint.isin(aligned.index), :]
+    partial = partial.assign(fingerprint=aligned.loc[
+        partial.fingerprint, 'match'].to_numpy())
+
+    # Aligned rows only get the sample wells the exact matches left over
+    taken = exact.loc[exact.plate_id.notna(), :]
+    taken = todo.loc[taken.index, :].groupby(
+        ['fingerprint', 'sample_id']).size().rename('taken')
+    partial = _claim_wells(partial, sample_prints, taken)
+
+    return pd.concat([exact, partial]).reindex(todo.index)
+
+
+def _claim_wells(todo, sample_prints, taken=None):
+    """
+    Join Rapid wells to the sample wells in their matched sample plate row.
+
+    The Nth Rapid well with a sample ID gets the Nth unclaimed sample well
+    with it. The taken series counts the sample wells that were already
+    claimed for each fingerprint and sample ID.
+    """
+    todo = todo.copy()
+    todo['occurrence'] = todo.groupby(['fingerprint', 'sample_id']).cumcount()
+    if taken is not None:
+        offset = todo.join(taken, on=['fingerprint', 'sample_id']).taken
+        todo['occurrence'] += offset.fillna(0).astype(int)
+
+    return todo.join(
+        sample_prints, on=['fingerprint', 'sample_id', 'occurrence'],
+        how='left')[['plate_id', 'well']]
+
+
+def _report_alignments(unknown, aligned, sample_prints):
+    """Show which Rapid rows only partially matched a sample plate row."""
+    rows = sample_prints.reset_index().drop_duplicates('fingerprint')
+    rows = rows.set_index('fingerprint')
+    keys = unknown.drop_duplicates(['source_plate', 'source_row'])
+    for key in keys.itertuples(index=False):
+        rapid_key = (key.source_plate, key.source_row)
+        if key.fingerprint in aligned.index:
+            row = rows.loc[aligned.at[key.fingerprint, 'match']]
+            score = aligned.at[key.fingerprint, 'score']
+            print(f'{rapid_key} partially matches plate {row.plate_id} '
+                  f'row {row.row}, overlap {score:.2f}')
+        else:
+            print(rapid_key)
+
+
+def _align_rows(rapid_rows, sample_rows):
+    """
+    Find the sample plate row that best overlaps each Rapid row.
+
+    The sample plate rows are indexed with locality sensitive hashing (LSH)
+    of their MinHash signatures, so a Rapid row is only compared to the rows
+    that are likely to share most of its sample IDs. The candidates are
+    scored by the Jaccard overlap of their sample ID sets. Returns the best
+    sample row's fingerprint and its score for every Rapid row that has a
+    score of at least MIN_OVERLAP, indexed by the Rapid row's fingerprint.
+    """
+    rapid_bands = _lsh_bands(_min_hashes(rapid_rows))
+    sample_bands = _lsh_bands(_min_hashes(sample_rows))
+    pairs = rapid_bands.merge(
+        sample_bands, on=['band', 'bucket'], suffixes=('', '_sample'))
+    pairs = pairs[['fingerprint', 'fingerprint_sample']].drop_duplicates()
+
+    rapid_sets = rapid_rows.groupby('fingerprint').sample_id.agg(set)
+    sample_sets = sample_rows.groupby('fingerprint').sample_id.agg(set)
+
+    best = {}
+    for rapid, sample in pairs.itertuples(index=False):
+        ids, other = rapid_sets[rapid], sample_sets[sample]
+        score = len(ids & other) / len(ids | other)
+        if score >= MIN_OVERLAP and score > best.get(rapid, (0, 0.0))[1]:
+            best[rapid] = (sample, score)
+
+    aligned = pd.DataFrame(
+        [(r, s, c) for r, (s, c) in best.items()],
+        columns=['fingerprint', 'match', 'score'])
+    aligned['match'] = aligned.match.astype('uint64')
+    return aligned.set_index('fingerprint')
+
+
+def _min_hashes(wells):
+    """Get the MinHash signature of each row's set of sample IDs."""
+    wells = wells.drop_duplicates(['fingerprint', 'sample_id'])
+    hashes = pd.util.hash_array(wells.sample_id.to_numpy(dtype=object))
+    permuted = hashes[:, np.newaxis] * MINHASH_A + MINHASH_B
+    permuted ^= permuted >> np.uint64(29)
+    signatures = pd.DataFrame(permuted, index=wells.fingerprint.to_numpy())
+    return signatures.groupby(level=0).min()
+
+
+def _lsh_bands(signatures):
+    """Hash each band of the signatures into a bucket."""
+    bands = []
+    for band, start in enumerate(range(0, NUM_PERM, BAND_SIZE)):
+        chunk = signatures.iloc[:, start:start + BAND_SIZE]
+        bands.append(pd.DataFrame({
+            'fingerprint': signatures.index.to_numpy(),
+            'band': band,
+            'bucket': pd.util.hash_pandas_object(chunk, index=False)}))
+    return pd.concat(bands, ignore_index=True)
 
 
 def _get_rapid_fingerprints(dfm):
-    fingerprints = {}
-    for _, well in dfm.iterrows():
-        key = (well.source_plate, well.source_row)
-        fingerprints.setdefault(key, [''] * 12)
-        if is_uuid(well.sample_id):
-            fingerprints[key][well.source_col - 1] = well.sample_id
-    return {k: tuple(sorted(v)) for k, v in fingerprints.items() if any(v)}
+    """Get the fingerprint of every Rapid plate row."""
+    dfm = dfm.loc[dfm.valid_uuid.astype(bool), :]
+    dfm = dfm.drop_duplicates(
+        ['source_plate', 'source_row', 'source_col'], keep='last')
+    return _row_fingerprints(dfm, ['source_plate', 'source_row'])
 
 
 def _get_sample_fingerprints(dfm):
-    fingerprints = {}
-    for _, well in dfm.iterrows():
-        key = (well.plate_id, well.row)
-        fingerprints.setdefault(key, [''] * 12)
-        if is_uuid(well.sample_id):
-            fingerprints[key][well.col - 1] = well.sample_id
-    return {tuple(sorted(v)): {'plate_id': k[0], 'row': k[1], 'sample_ids': v}
-            for k, v in fingerprints.items() if any(v)}
+    """Index sample wells by their row's fingerprint and their sample ID."""
+    prints = _row_fingerprints(dfm, ['plate_id', 'row'])
+    prints = prints[~prints.duplicated(keep='last')]
+
+    dfm = dfm.join(prints, on=['plate_id', 'row'], how='inner')
+    dfm = dfm.sort_values(['plate_id', 'row', 'col'])
+    dfm['occurrence'] = dfm.groupby(
+        ['plate_id', 'row', 'sample_id']).cumcount()
+
+    dfm = dfm.set_index(['fingerprint', 'sample_id', 'occurrence'])
+    return dfm[['plate_id', 'row', 'well']]
+
+
+def _row_fingerprints(dfm, keys):
+    """Hash each row's sorted sample IDs."""
+    dfm = dfm.loc[dfm.sample_id.notna() & (dfm.sample_id != ''), :]
+    ids = dfm.sort_values('sample_id').groupby(keys).sample_id.agg(' '.join)
+    ids = ids.reindex(pd.MultiIndex.from_frame(dfm[keys].drop_duplicates()))
+    hashes = pd.util.hash_array(ids.to_numpy(dtype=object))
+    return pd.Series(hashes, index=ids.index, name='fingerprint')
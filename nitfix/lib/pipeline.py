@@ -0,0 +1,230 @@
+"""Rebuild only the database tables that are out of date.
+
+Each step is a script along with the tables it reads and writes and the
+outside data it uses: Google sheets, files, and directories. A step's
+fingerprint is a hash of its script, the lib modules it imports, its outside
+data, and the fingerprints of the steps it depends on. A step is stale when
+its fingerprint differs from the one stored after its last successful run.
+Because the fingerprints chain, rebuilding a step makes everything
+downstream of it stale too.
+
+A step depends on every earlier step that writes a table it reads or
+writes, so steps must be declared in an order that works when run one after
+another, like the old Makefile. SQLite only allows one writer at a time and
+the table swaps hold the write lock for a whole load, so steps that write
+tables run one at a time. Steps that only read, like the reports, run in
+parallel with them once their dependencies are finished.
+"""
+
+import ast
+import hashlib
+import os
+import subprocess
+import sys
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from pathlib import Path
+from . import db
+from . import google
+from .util import PROCESSES
+
+SRC = Path(__file__).resolve().parent.parent
+LIB = SRC / 'lib'
+
+# The script's name, the tables it reads and writes, and its outside data.
+# Sheets are Google sheet names, files are paths, and dirs are directories
+# with a glob pattern for the files in them that matter.
+Step = namedtuple(
+    'Step', 'script reads writes sheets files dirs', defaults=((),) * 5)
+
+
+def run(steps, force=None, dry_run=False, processes=PROCESSES):
+    """Run every stale step and everything downstream of them."""
+    force = set(force) if force else set()
+    needs = dependencies(steps)
+    prints = fingerprints(steps, needs)
+    old_prints = get_old_fingerprints()
+
+    stale = set()
+    for step in steps:
+        script = step.script
+        if script in force or prints[script] != old_prints.get(script) \
+                or stale & set(needs[script]):
+            stale.add(script)
+        print(f'{"stale" if script in stale else "fresh"}   {script}')
+    if dry_run or not stale:
+        return set()
+
+    return run_stale(steps, needs, prints, stale, processes)
+
+
+def dependencies(steps):
+    """Find the earlier steps that write the tables each step uses."""
+    needs = {}
+    for i, step in enumerate(steps):
+        tables = set(step.reads) | set(step.writes)
+        needs[step.script] = [s.script for s in steps[:i]
+                              if tables & set(s.writes)]
+    return needs
+
+
+def fingerprints(steps, needs):
+    """Build each step's fingerprint from its inputs and upstream steps."""
+    sheets = [s for step in steps for s in step.sheets]
+    times = google.sheet_modified_times(sheets) if sheets else {}
+
+    prints = {}
+    for step in steps:
+        parts = [file_print(SRC / step.script)]
+        parts += [file_print(m) for m in lib_imports(SRC / step.script)]
+        parts += [f'{s} {times[s]}' for s in step.sheets]
+        parts += [file_print(f) for f in step.files]
+        parts += [dir_print(d, p) for d, p in step.dirs]
+        parts += [prints[s] for s in needs[step.script]]
+        prints[step.script] = digest(parts)
+    return prints
+
+
+def run_stale(steps, needs, prints, stale, processes):
+    """Run the stale steps, each one as soon as its dependencies finish."""
+    pending = [s.script for s in steps if s.script in stale]
+    writers = {s.script for s in steps if s.writes}
+    running = {}
+    failed = set()
+    done = set()
+
+    with ThreadPoolExecutor(max_workers=processes) as executor:
+        while pending or running:
+            for script in list(pending):
+                upstream = [s for s in needs[script] if s in stale]
+                if any(s in failed for s in upstream):
+                    print(f'skipped {script}')
+                    pending.remove(script)
+                    failed.add(script)
+                elif all(s in done for s in upstream):
+                    if script in writers and writers & set(running.values()):
+                        continue
+                    pending.remove(script)
+                    future = executor.submit(run_script, script)
+                    running[future] = script
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                script = running.pop(future)
+                if future.result() == 0:
+                    done.add(script)
+                    save_fingerprint(script, prints[script])
+                else:
+                    failed.add(script)
+                    print(f'failed  {script}')
+
+    return failed
+
+
+def run_script(script):
+    """Run one step's script the same way the Makefile did."""
+    print(f'start   {script}')
+    result = subprocess.run(
+        [sys.executable, str(SRC / script)], cwd=SRC.parent, check=False)
+    print(f'end     {script}')
+    return result.returncode
+
+
+def get_old_fingerprints():
+    """Get the fingerprints saved after each step last ran."""
+    cxn = db.connect()
+    create_fingerprints_table(cxn)
+    sql = 'SELECT script, fingerprint FROM pipeline_fingerprints;'
+    return dict(cxn.execute(sql))
+
+
+def save_fingerprint(script, fingerprint):
+    """Remember the fingerprint of a step that ran successfully."""
+    with db.session() as cxn:
+        cxn.execute(
+            """INSERT OR REPLACE INTO pipeline_fingerprints
+                      (script, fingerprint, run_at)
+               VALUES (?, ?, ?);""",
+            (script, fingerprint, datetime.now().isoformat()))
+
+
+def create_fingerprints_table(cxn):
+    """Create the table of fingerprints if it isn't there."""
+    with cxn:
+        cxn.execute("""
+            CREATE TABLE IF NOT EXISTS pipeline_fingerprints (
+                script      TEXT PRIMARY KEY,
+                fingerprint TEXT,
+                run_at      TEXT);""")
+
+
+def file_print(path):
+    """Fingerprint a file with its contents."""
+    path = Path(path)
+    return f'{path} {file_digest(path) if path.exists() else "missing"}'
+
+
+def file_digest(path, block=2**20):
+    """Hash a file's entire contents so any edit changes the fingerprint."""
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as in_file:
+        for chunk in iter(lambda: in_file.read(block), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def lib_imports(path):
+    """Find the lib modules a script imports, directly or through lib."""
+    found = set()
+    todo = [Path(path)]
+    while todo:
+        path = todo.pop()
+        for module in imported_names(path, relative=path.parent == LIB):
+            module = LIB / f'{module}.py'
+            if module.exists() and module not in found:
+                found.add(module)
+                todo.append(module)
+    return sorted(found)
+
+
+def imported_names(path, relative):
+    """Get the names of the lib modules imported by a file."""
+    names = []
+    for node in ast.walk(ast.parse(path.read_bytes(), str(path))):
+        if isinstance(node, ast.Import):
+            names += [a.name for a in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            if node.level == 1 and relative:
+                package = 'lib'
+            elif node.level == 0:
+                package = ''
+            else:
+                continue
+            module = '.'.join(n for n in (package, node.module) if n)
+            if module == 'lib':
+                names += [f'lib.{a.name}' for a in node.names]
+            else:
+                names.append(module)
+    return [n.split('.')[1] for n in names if n.startswith('lib.')]
+
+
+def dir_print(path, pattern):
+    """Fingerprint a directory with the names, sizes, & times of its files."""
+    parts = []
+    for file_ in sorted(Path(path).glob(pattern)):
+        stat = file_.stat()
+        parts.append(f'{file_} {stat.st_size} {stat.st_mtime_ns}')
+    return digest(parts)
+
+
+def digest(parts):
+    """Hash a list of strings."""
+    hasher = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        hasher.update(os.fsencode(part))
+        hasher.update(b'\0')
+    return hasher.hexdigest()
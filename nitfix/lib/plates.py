@@ -0,0 +1,109 @@
+"""A compact representation of 96-well plates.
+
+Wells are indexed 0 to 95 across the rows: A01 is 0, A12 is 11, B01 is 12,
+and H12 is 95. The well_no used in the database is this index plus one.
+
+A PlateArray holds one value for every well of a set of plates in a NumPy
+array shaped (plates, 8, 12), so whole plates can be filled and read
+without building a Python object for each well.
+"""
+
+import numpy as np
+import pandas as pd
+
+ROWS = 'ABCDEFGH'
+COLUMNS = 12
+WELLS = len(ROWS) * COLUMNS
+
+ROW_NAMES = np.array(list(ROWS))
+WELL_NAMES = np.array([f'{r}{c:02d}' for r in ROWS for c in range(1, 13)])
+
+
+def well_index(rows, cols):
+    """Get the well index of row letters and 1-based column numbers."""
+    rows = np.asarray(rows, dtype='U1')
+    rows = rows.view(np.int32).reshape(rows.shape) - ord('A')
+    return rows * COLUMNS + np.asarray(cols, dtype=int) - 1
+
+
+def parse_wells(wells):
+    """Get the well index of well names like 'A01' or 'a1'."""
+    wells = pd.Series(wells, dtype=str).str.strip().str.upper()
+    return well_index(wells.str[0].to_numpy(), wells.str[1:].astype(int))
+
+
+def well_names(index):
+    """Get the well names for well indexes."""
+    return WELL_NAMES[index]
+
+
+def well_rows(index):
+    """Get the row letters for well indexes."""
+    return ROW_NAMES[np.asarray(index) // COLUMNS]
+
+
+def well_cols(index):
+    """Get the 1-based column numbers for well indexes."""
+    return np.asarray(index) % COLUMNS + 1
+
+
+def all_wells(plate_ids):
+    """Get a data frame with every well of every plate in plate order."""
+    plate_ids = np.asarray(plate_ids)
+    index = np.tile(np.arange(WELLS), len(plate_ids))
+    return pd.DataFrame({
+        'plate_id': np.repeat(plate_ids, WELLS),
+        'row': well_rows(index),
+        'col': well_cols(index),
+        'well': well_names(index),
+        'well_no': index + 1})
+
+
+class PlateArray:
+    """One value for every well of a set of plates."""
+
+    def __init__(self, plate_ids, fill=None, dtype=object):
+        """Create plates with every well set to the fill value."""
+        self.plate_ids = pd.Index(plate_ids)
+        self.values = np.full(
+            (len(self.plate_ids), len(ROWS), COLUMNS), fill, dtype=dtype)
+
+    @classmethod
+    def from_wells(cls, plate_ids, wells, values, fill=None, dtype=object):
+        """Build plates from parallel arrays of plate IDs, wells, & values."""
+        plates = cls(pd.unique(np.asarray(plate_ids)), fill, dtype)
+        plates.set(plate_ids, wells, values)
+        return plates
+
+    @property
+    def flat(self):
+        """A (plates, 96) view of the values."""
+        return self.values.reshape(len(self.plate_ids), WELLS)
+
+    def locate(self, plate_ids, wells):
+        """Get the plate positions and well indexes of the wells."""
+        plates = self.plate_ids.get_indexer(np.asarray(plate_ids))
+        if (plates < 0).any():
+            raise KeyError('Some plate IDs are not in the plate array')
+        wells = np.asarray(wells)
+        if wells.dtype.kind not in 'iu':
+            wells = parse_wells(wells)
+        return plates, wells
+
+    def set(self, plate_ids, wells, values):
+        """Set the values of the given wells."""
+        self.flat[self.locate(plate_ids, wells)] = values
+
+    def get(self, plate_ids, wells):
+        """Get the values of the given wells."""
+        return self.flat[self.locate(plate_ids, wells)]
+
+    def plate(self, plate_id):
+        """Get one plate's 8 x 12 array of values."""
+        return self.values[self.plate_ids.get_loc(plate_id)]
+
+    def to_frame(self, name='value'):
+        """Get a data frame with a row for every well of every plate."""
+        wells = all_wells(self.plate_ids)
+        wells[name] = self.flat.ravel()
+        return wells
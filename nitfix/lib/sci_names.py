@@ -0,0 +1,311 @@
+"""Match scientific names from other datasets to the master taxonomy.
+
+The taxonomy_synonyms table maps every accepted name and every synonym in the
+taxonomy to its accepted name. Names are matched on a normalized key so
+differences in case, spacing, or underscores don't matter. Datasets resolve
+all of their names with one merge against this table.
+
+Names that still don't match, because of a misspelling or an authority
+string, can be matched fuzzily. The fuzzy matcher only compares a name to
+the taxonomy names in the same genus, and then it only scores the epithets so
+the shared genus doesn't make different species look alike. When the genus
+itself isn't in the taxonomy it uses the names that share enough n-grams with
+the name. Those candidates are scored with a bit-parallel edit distance.
+
+Infraspecific names only match taxonomy names of the same rank. A variety
+won't match its species when the taxonomy doesn't list the variety, and
+"subsp." won't match "var.". Resolve the species name separately when the
+species is good enough.
+"""
+
+import re
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+from . import db
+
+TABLE = 'taxonomy_synonyms'
+
+GRAM = 3  # The n-gram size used to find candidates for a fuzzy match
+MIN_SCORE = 0.9  # Fuzzy matches must be at least this good
+
+# Get the genus, epithet, and infraspecific name while skipping authorities
+NAME = re.compile(
+    r""" ^ \s* ([a-z][a-z-]*) \.?
+        (?: \s+ ([a-z][a-z-]*) )?
+        (?: \s+ (var|subsp|ssp|f|forma) \.? \s+ ([a-z][a-z-]*) )? """,
+    re.VERBOSE)
+RANKS = {'ssp': 'subsp', 'forma': 'f'}
+
+
+def normalize_names(names):
+    """Build the lookup key for a series of names."""
+    return (names.str.replace('_', ' ', regex=False)
+            .str.split().str.join(' ').str.lower())
+
+
+def canonical_names(names):
+    """Get the lower case genus, epithet, and rank without any authority."""
+    parts = (names.str.replace('_', ' ', regex=False).str.split().str.join(' ')
+             .str.replace(r'^(\S+)', lambda m: m[1].lower(), regex=True)
+             .str.extract(NAME))
+    parts[2] = parts[2].replace(RANKS)
+    canonical = parts[0].str.cat(parts.iloc[:, 1:], sep=' ', na_rep='')
+    return canonical.str.split().str.join(' ').replace('', np.nan)
+
+
+def create_synonyms_table(cxn):
+    """
+    Build the synonym index from the taxonomy table.
+
+    An accepted name always wins over a synonym with the same key. A synonym
+    that is listed under more than one taxon goes to the first one.
+    """
+    taxonomy = pd.read_sql(
+        'SELECT sci_name, synonyms FROM taxonomy ORDER BY rowid;', cxn)
+
+    accepted = taxonomy[['sci_name']].assign(
+        name=taxonomy.sci_name, is_synonym=0)
+
+    synonyms = taxonomy[['sci_name']].assign(
+        name=taxonomy.synonyms.str.split(r'\s*[;,]\s*'), is_synonym=1)
+    synonyms = synonyms.explode('name', ignore_index=True)
+
+    index = pd.concat([accepted, synonyms], ignore_index=True)
+    index['name_key'] = normalize_names(index.name)
+
+    not_na = index.name_key.notna()
+    not_blank = index.name_key != ''
+    index = index.loc[not_na & not_blank, :]
+    index = index.drop_duplicates('name_key')
+
+    db.load_table(
+        cxn, TABLE, index[['name_key', 'name', 'sci_name', 'is_synonym']],
+        schema={'name_key': 'TEXT', 'name': 'TEXT', 'sci_name': 'TEXT',
+                'is_synonym': 'INTEGER'},
+        indexes=[
+            f"""CREATE UNIQUE INDEX IF NOT EXISTS
+                    {TABLE}_name_key ON {TABLE} (name_key);""",
+            f"""CREATE INDEX IF NOT EXISTS
+                    {TABLE}_sci_name ON {TABLE} (sci_name);"""])
+
+
+def get_synonyms(cxn=None):
+    """Get the synonym index keyed on the normalized name."""
+    cxn = cxn if cxn else db.connect(readonly=True)
+    return pd.read_sql(
+        f'SELECT name_key, name, sci_name, is_synonym FROM {TABLE};', cxn)
+
+
+def resolve_names(names, cxn=None, synonyms=None):
+    """
+    Get the accepted taxonomy name for every name in a series.
+
+    Names that are not in the taxonomy become NaN. The result has the same
+    index as the names.
+    """
+    synonyms = synonyms if synonyms is not None else get_synonyms(cxn)
+
+    keys = normalize_names(names).to_frame('name_key')
+    resolved = keys.merge(
+        synonyms[['name_key', 'sci_name']], how='left', on='name_key')
+
+    return pd.Series(
+        resolved.sci_name.to_numpy(), index=names.index, name='sci_name')
+
+
+def best_matches(names, cxn=None, synonyms=None, min_score=MIN_SCORE):
+    """
+    Get the closest taxonomy name for every name in a series.
+
+    The result has a sci_name and a score column. The score is 1.0 for
+    exact matches and NaN when nothing is close enough. Callers should not
+    replace a name with a match scoring under 1.0 without a review. The
+    names' index must be unique.
+    """
+    matches = match_names(
+        names, cxn=cxn, synonyms=synonyms, limit=1, min_score=min_score)
+    return matches[['sci_name', 'score']].reindex(names.index)
+
+
+def match_names(names, cxn=None, synonyms=None, limit=3,
+                min_score=MIN_SCORE):
+    """
+    Rank the taxonomy names that are close to each name in a series.
+
+    There is a row for each match, up to the limit, indexed by the name's
+    index. Matches are ranked from 0 by their score, the best first.
+    """
+    synonyms = synonyms if synonyms is not None else get_synonyms(cxn)
+    index = NameIndex(synonyms)
+
+    keys = canonical_names(names)
+    found = {k: index.match(k, limit, min_score)
+             for k in keys.dropna().unique()}
+
+    rows, labels = [], []
+    for label, name, key in zip(names.index, names, keys):
+        for rank, (target, score) in enumerate(found.get(key, [])):
+            labels.append(label)
+            rows.append({
+                'name': name,
+                'matched_name': index.targets.at[target, 'name'],
+                'sci_name': index.targets.at[target, 'sci_name'],
+                'score': score,
+                'rank': rank})
+
+    columns = ['name', 'matched_name', 'sci_name', 'score', 'rank']
+    return pd.DataFrame(rows, index=labels, columns=columns)
+
+
+class NameIndex:
+    """Find the taxonomy names that are closest to a canonical name."""
+
+    def __init__(self, synonyms):
+        """Build the lookups from the synonym index."""
+        targets = synonyms.assign(key=canonical_names(synonyms.name))
+        targets = targets.dropna(subset=['key'])
+        self.targets = targets.sort_values('is_synonym', kind='stable')
+        self.targets = self.targets.reset_index(drop=True)
+
+        self.keys = self.targets.key.tolist()
+        self.lengths = np.array([len(k) for k in self.keys])
+        self.epithets = [k.partition(' ')[2] for k in self.keys]
+        self.epithet_lengths = np.array([len(e) for e in self.epithets])
+
+        self.exact = defaultdict(list)
+        self.genera = defaultdict(list)
+        grams = defaultdict(list)
+        for i, key in enumerate(self.keys):
+            self.exact[key].append(i)
+            self.genera[key.split()[0]].append(i)
+            for gram in ngrams(key):
+                grams[gram].append(i)
+
+        self.grams = {g: np.array(i) for g, i in grams.items()}
+
+    def match(self, key, limit=3, min_score=MIN_SCORE):
+        """Get the best (target, score) pairs, one per accepted name."""
+        if key in self.exact:
+            hits = [(i, 1.0) for i in self.exact[key]]
+        else:
+            hits = self.fuzzy_match(key, min_score)
+
+        hits = sorted(hits, key=lambda h: -h[1])
+        ranked, seen = [], set()
+        for target, score in hits:
+            sci_name = self.targets.at[target, 'sci_name']
+            if sci_name not in seen:
+                seen.add(sci_name)
+                ranked.append((target, score))
+        return ranked[:limit]
+
+    def fuzzy_match(self, key, min_score):
+        """
+        Score the candidates that could be close enough to the key.
+
+        Names in the key's genus are scored on their epithets alone.
+        """
+        genus, _, epithet = key.partition(' ')
+        if genus in self.genera:
+            candidates = np.array(self.genera[genus])
+            key, texts, lengths = epithet, self.epithets, self.epithet_lengths
+        else:
+            candidates = self.gram_candidates(key, min_score)
+            texts, lengths = self.keys, self.lengths
+
+        longest = np.maximum(lengths[candidates], len(key))
+        max_dist = max_distance(longest, min_score)
+        too_long = np.abs(lengths[candidates] - len(key)) > max_dist
+        candidates = candidates[~too_long]
+
+        pattern = bit_pattern(key)
+        hits = []
+        for target in candidates:
+            text = texts[target]
+            if not text or not key:
+                continue
+            dist = edit_distance(pattern, len(key), text)
+            score = 1.0 - dist / max(len(key), len(text))
+            if score >= min_score:
+                hits.append((target, score))
+        return hits
+
+    def gram_candidates(self, key, min_score):
+        """
+        Find the names that share enough n-grams with the key.
+
+        Two strings within an edit distance of d share at least
+        max(len) - 1 - (d - 1) * n padded n-grams. Counting each of the key's
+        n-grams once per occurrence in a name overcounts, so this never drops
+        a real match.
+        """
+        postings = [self.grams[g] for g in set(ngrams(key)) if g in self.grams]
+        if not postings:
+            return np.array([], dtype=int)
+
+        shared = np.bincount(
+            np.concatenate(postings), minlength=len(self.keys))
+        longest = np.maximum(self.lengths, len(key))
+        max_dist = max_distance(longest, min_score)
+        needed = longest - 1 - (max_dist - 1) * GRAM
+
+        return np.flatnonzero((shared > 0) & (shared >= needed))
+
+
+def max_distance(longest, min_score):
+    """
+    Get the most edits a name of the longest length can have and still pass.
+
+    The small tolerance keeps float error from dropping a score that is
+    exactly the minimum, like 1 - 3/30 for a min_score of 0.9.
+    """
+    return np.floor((1.0 - min_score) * longest + 1e-9)
+
+
+def ngrams(text):
+    """Get the padded n-grams in the text."""
+    pad = ' ' * (GRAM - 1)
+    text = pad + text + pad
+    return [text[i:i + GRAM] for i in range(len(text) - GRAM + 1)]
+
+
+def bit_pattern(pattern):
+    """Get the bit mask of each character's positions in the pattern."""
+    masks = defaultdict(int)
+    for i, char in enumerate(pattern):
+        masks[char] |= 1 << i
+    return masks
+
+
+def edit_distance(masks, length, text):
+    """
+    Get the Levenshtein distance between a pattern and the text.
+
+    This is Myers' bit-parallel algorithm as given by Hyyrö. Each column of
+    the distance matrix is a pair of bit vectors, so it takes one pass over
+    the text no matter how long the pattern is.
+    """
+    if not length:
+        return len(text)
+
+    ones = (1 << length) - 1
+    last = 1 << (length - 1)
+    pos, neg, dist = ones, 0, length
+
+    for char in text:
+        eq = masks.get(char, 0)
+        x_v = eq | neg
+        x_h = (((eq & pos) + pos) ^ pos) | eq
+        h_pos = neg | (~(x_h | pos) & ones)
+        h_neg = pos & x_h
+        if h_pos & last:
+            dist += 1
+        elif h_neg & last:
+            dist -= 1
+        h_pos = ((h_pos << 1) | 1) & ones
+        h_neg = (h_neg << 1) & ones
+        pos = h_neg | (~(x_v | h_pos) & ones)
+        neg = h_pos & x_v
+
+    return dist
@@ -0,0 +1,89 @@
+"""Keep snapshots of the Google sheets so the pipeline can run offline.
+
+Sheet exports are stored gzipped under the hash of their contents, so a
+sheet that didn't change between snapshots is only stored once. A snapshot
+is a small JSON file mapping each sheet's name to its contents' hash and its
+modified time on Google.
+
+To replay a snapshot set the NITFIX_SNAPSHOT environment variable to its
+name. Every script then reads the sheets from the snapshot instead of from
+Google.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+from datetime import datetime
+from .util import INTERIM_DATA
+
+SNAPSHOT_DIR = INTERIM_DATA / 'sheet_snapshots'
+OBJECT_DIR = SNAPSHOT_DIR / 'objects'
+REPLAY_VAR = 'NITFIX_SNAPSHOT'
+
+
+def replay_name():
+    """Get the name of the snapshot being replayed, if any."""
+    return os.environ.get(REPLAY_VAR)
+
+
+def save_snapshot(sheets, name=None):
+    """
+    Save a snapshot of sheets that were already exported.
+
+    Sheets maps a sheet's name to the path of its CSV export and its modified
+    time on Google.
+    """
+    name = name if name else datetime.now().strftime('%Y-%m-%dT%H-%M-%S')
+    manifest = {'created': datetime.now().isoformat(), 'sheets': {}}
+
+    for sheet_name, (csv_path, modified) in sorted(sheets.items()):
+        data = csv_path.read_bytes()
+        manifest['sheets'][sheet_name] = {
+            'hash': save_object(data),
+            'modifiedTime': modified}
+
+    path = snapshot_path(name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(manifest, indent=2))
+    return name
+
+
+def save_object(data):
+    """Store the data under the hash of its contents."""
+    key = hashlib.blake2b(data, digest_size=16).hexdigest()
+    path = object_path(key)
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp = path.with_suffix(f'.{os.getpid()}.tmp')
+        temp.write_bytes(gzip.compress(data, mtime=0))
+        os.replace(temp, path)
+    return key
+
+
+def load_snapshot(name):
+    """Get the sheets in a snapshot."""
+    path = snapshot_path(name)
+    if not path.exists():
+        raise FileNotFoundError(f'There is no sheet snapshot named {name}')
+    return json.loads(path.read_text())['sheets']
+
+
+def load_object(key):
+    """Get the data stored under the hash."""
+    return gzip.decompress(object_path(key).read_bytes())
+
+
+def list_snapshots():
+    """Get the names of the snapshots, the oldest first."""
+    return sorted(p.stem for p in SNAPSHOT_DIR.glob('*.json'))
+
+
+def snapshot_path(name):
+    """Get the path to a snapshot's manifest."""
+    return SNAPSHOT_DIR / f'{name}.json'
+
+
+def object_path(key):
+    """Get the path to a stored sheet export."""
+    return OBJECT_DIR / key[:2] / f'{key}.csv.gz'
@@ -1,8 +1,8 @@
 """Holds miscellaneous utility function."""
 
+import hashlib
 import os
 import re
-import uuid
 from os.path import basename, join, split
 from pathlib import Path
 
@@ -15,6 +15,7 @@ EXPEDITION_DATA = RAW_DATA / 'expeditions'
 SAMPLED_DATA = RAW_DATA / 'sampled_images'
 PHOTOS = RAW_DATA / 'photos'
 ADJUSTED_DIR = RAW_DATA / 'adjusted'  # Where to store color adjusted images
+DERIVED_IMAGES = INTERIM_DATA / 'derived_images'  # Shrunk & rotated images
 IMAGE_DIRS = [
     'CAS-DOE-nitfix_specimen_photos',
     'DOE-nitfix_specimen_photos',
@@ -75,6 +76,13 @@ TAXONOMY_SHEETS = {
     'tingshuang': 'Tingshuang_NitFixMasterTaxonomy',
 }
 
+# Every sheet the ingest scripts read, these go into sheet snapshots
+ALL_SHEETS = [
+    CORRALES_SHEET, GENBANK_LOCI_SHEET, PILOT_DATA_SHEET, PRIORITY_TAXA_SHEET,
+    SAMPLE_PLATES_SHEET, *LOCI_SHEETS, *NORMAL_PLATE_SHEETS,
+    *QC_NORMAL_PLATE_SHEETS, *REFORMATTING_TEMPLATE_SHEETS, *SAMPLE_SHEETS,
+    *SEQ_METADATA_SHEETS, *TAXONOMY_SHEETS.values()]
+
 # Notes from Nature expedition worksheets are downloaded and stored locally
 # EXPEDITIONS = [
 #     '5657_Nit_Fix_I.reconcile.4.3.csv',
@@ -96,6 +104,14 @@ LOCAL_ID = re.compile(
     r'^.*? (nitfix|rosales|test) \D* (\d+) \D*$',
     re.IGNORECASE | re.VERBOSE)
 
+# This is used to recognize valid UUIDs. It accepts the same forms that
+# uuid.UUID() does in practice: optional braces and optional dashes.
+UUID = re.compile(
+    r""" ^ \s* \{?
+        ([0-9a-f]{8}) -? ([0-9a-f]{4}) -? ([0-9a-f]{4}) -? ([0-9a-f]{4})
+        -? ([0-9a-f]{12}) \}? \s* $ """,
+    re.IGNORECASE | re.VERBOSE)
+
 PROCESSES = max(1, min(10, os.cpu_count() - 4))  # How many processes to use
 
 
@@ -108,15 +124,41 @@ class ReplaceDict(dict):
 
 
 def is_uuid(guid):
-    """Create a function to determine if a string is a valid UUID."""
-    if not guid:
-        guid = ''
-    guid = str(guid).strip()
-    try:
-        uuid.UUID(guid)
-        return True
-    except (ValueError, AttributeError):
-        return False
+    """Determine if a string is a valid UUID."""
+    return bool(guid) and UUID.match(str(guid)) is not None
+
+
+def normalize_uuid(guid):
+    """Get the lower case, dashed form of a UUID or None if it isn't one."""
+    match = UUID.match(str(guid)) if guid else None
+    return '-'.join(match.groups()).lower() if match else None
+
+
+def normalize_uuids(series):
+    """Normalize a series of UUIDs all at once, other values become NaN."""
+    parts = series.astype(str).str.extract(UUID)
+    return parts[0].str.cat(parts.iloc[:, 1:], sep='-').str.lower()
+
+
+def clean_uuids(series):
+    """Normalize the UUIDs in a series and keep any other values as is."""
+    return normalize_uuids(series).fillna(series)
+
+
+def fast_hash(path, block=2**16):
+    """Hash a file's size and its first and last blocks.
+
+    This is much quicker than hashing an entire photo and it is still good
+    enough to tell when a photo has been replaced.
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(path, 'rb') as in_file:
+        digest.update(in_file.read(block))
+        if size > block:
+            in_file.seek(max(block, size - block))
+            digest.update(in_file.read(block))
+    return digest.hexdigest()
 
 
 def normalize_file_name(path):
@@ -39,7 +39,7 @@ def save(df, sheet):
     df.to_csv(name, index=False)
 
     table = 'nodulation_' + sheet
-    df.to_sql(table, db.connect(), if_exists='replace', index=False)
+    db.load_table(db.connect(), table, df)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,138 @@
+"""Rebuild the database tables that are out of date.
+
+This replaces running every ingest script in a fixed order. Each script is
+declared with the tables it reads and writes and the Google sheets and files
+it gets its data from. Only scripts whose data changed since their last run,
+and the scripts downstream of them, are run again.
+
+Order matters: a script depends on every script above it that writes a
+table it uses.
+"""
+
+import argparse
+import os
+from os.path import splitext
+
+import lib.pipeline as pipeline
+import lib.snapshots as snapshots
+import lib.util as util
+from lib.pipeline import Step
+
+TAXONOMY_TABLES = list(util.TAXONOMY_SHEETS.values())
+REFORMATTING_TABLES = [
+    splitext(s)[0] for s in util.REFORMATTING_TEMPLATE_SHEETS]
+
+STEPS = [
+    # Images
+    Step('ingest_images.py',
+         writes=['images', 'image_errors', 'image_scans', 'image_qr_codes',
+                 'qr_priors'],
+         dirs=[(util.PHOTOS / d, '*.[Jj][Pp][Gg]') for d in util.IMAGE_DIRS]),
+    Step('ingest_pilot_data.py',
+         writes=['pilot_data', 'images'],
+         sheets=[util.PILOT_DATA_SHEET]),
+    Step('ingest_corrales_data.py',
+         writes=['corrales_data', 'images'],
+         sheets=[util.CORRALES_SHEET]),
+
+    # Taxonomy
+    Step('ingest_taxonomies.py',
+         writes=['taxonomy', 'taxonomy_ids'] + TAXONOMY_TABLES
+         + [t + '_ids' for t in TAXONOMY_TABLES],
+         sheets=TAXONOMY_TABLES),
+    Step('audit_taxonomy.py',
+         writes=['taxonomy_errors', 'taxonomy', 'taxonomy_ids',
+                 'taxonomy_synonyms']),
+
+    # Other
+    Step('ingest_loci_data.py',
+         reads=['taxonomy_synonyms'],
+         writes=['genbank_loci'],
+         sheets=[util.GENBANK_LOCI_SHEET]),
+    Step('ingest_sprent_data.py',
+         writes=['sprent_data'],
+         files=[util.SPRENT_DATA_CSV]),
+    Step('ingest_non_fabales_data.py',
+         writes=['non_fabales_data'],
+         files=[util.NON_FABALES_CSV]),
+    Step('ingest_werner_data.py',
+         reads=['taxonomy_synonyms'],
+         writes=['nitfixwerneretal2014'],
+         files=[util.WERNER_DATA_XLS]),
+    Step('ingest_nfn_data.py',
+         writes=['nfn_data'],
+         dirs=[(util.EXPEDITION_DATA, '*.csv')]),
+    Step('ingest_priority_taxa.py',
+         writes=['priority_taxa'],
+         sheets=[util.PRIORITY_TAXA_SHEET]),
+
+    # Repair
+    Step('fix_sample_ids.py',
+         writes=['manual_corrections', 'taxonomy_ids', 'images',
+                 'image_errors'],
+         files=[util.RAW_DATA / 'missing_a_taxon.v3.HRK.csv']),
+
+    # Sequencing
+    Step('ingest_sample_plates.py',
+         writes=['sample_plates', 'sample_wells'],
+         sheets=[util.SAMPLE_PLATES_SHEET]),
+    Step('ingest_qc_normal_plate_layouts.py',
+         reads=['sample_wells'],
+         writes=['qc_normal_plate_layout'] + util.QC_NORMAL_PLATE_SHEETS,
+         sheets=util.QC_NORMAL_PLATE_SHEETS),
+    Step('ingest_reformatting_templates.py',
+         writes=['reformatting_templates'] + REFORMATTING_TABLES,
+         sheets=util.REFORMATTING_TEMPLATE_SHEETS),
+    Step('ingest_sample_sheets.py',
+         writes=['sample_sheets'] + util.SAMPLE_SHEETS,
+         sheets=util.SAMPLE_SHEETS),
+    Step('ingest_loci_assembled.py',
+         writes=['loci_assembled'] + util.LOCI_SHEETS,
+         sheets=util.LOCI_SHEETS),
+
+    # Reports
+    Step('sample_plate_report.py',
+         reads=['images', 'nfn_data', 'taxonomy', 'taxonomy_ids',
+                'reformatting_templates', 'loci_assembled',
+                'qc_normal_plate_layout', 'sample_plates', 'sample_wells']),
+    Step('sample_selection.py',
+         reads=['taxonomy_errors', 'taxonomy', 'taxonomy_ids',
+                'priority_taxa', 'sample_plates', 'sample_wells',
+                'qc_normal_plate_layout', 'reformatting_templates']),
+]
+
+
+def parse_args():
+    """Process command-line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        'force', nargs='*', metavar='SCRIPT',
+        help="""Run these scripts, and everything downstream of them, even
+            if they are up to date.""")
+    parser.add_argument(
+        '--all', action='store_true',
+        help="""Run every script.""")
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help="""Only list which scripts are stale.""")
+    parser.add_argument(
+        '--snapshot', metavar='NAME',
+        help="""Read the Google sheets from this snapshot instead of from
+            Google. See snapshot_sheets.py.""")
+    args = parser.parse_args()
+
+    unknown = set(args.force) - {s.script for s in STEPS}
+    if unknown:
+        parser.error(f'Unknown scripts: {", ".join(sorted(unknown))}')
+
+    return args
+
+
+if __name__ == '__main__':
+    ARGS = parse_args()
+    if ARGS.snapshot:
+        os.environ[snapshots.REPLAY_VAR] = ARGS.snapshot  # For the scripts
+    FORCE = [s.script for s in STEPS] if ARGS.all else ARGS.force
+    FAILED = pipeline.run(STEPS, force=FORCE, dry_run=ARGS.dry_run)
+    if FAILED:
+        raise SystemExit(f'Failed: {", ".join(sorted(FAILED))}')
@@ -29,15 +29,16 @@ def get_wells(cxn):
                rt.volume, rt.rapid_source, rt.rapid_dest, rt.source_plate,
                rt.sample_id is not null as seq_returned,
                la.loci_assembled,
-               sw.plate_id, sw.entry_date, sw.local_id, sw.local_no,
-               sw.rapid_plates, sw.notes, sw.results, sw.row, sw.col,
+               sw.plate_id, sp.entry_date, sp.local_id, sp.local_no,
+               sp.rapid_plates, sp.notes, sp.results, sw.row, sw.col,
                sw.well, sw.well_no
         from reformatting_templates as rt
         left join qc_normal_plate_layout as qc using (rapid_source)
         left join taxonomy_ids as ti using (sample_id)
         left join taxonomy as tx using (sci_name)
         left join loci_assembled as la using (rapid_dest)
-        left join sample_wells as sw using (plate_id, well);
+        left join sample_wells as sw using (plate_id, well)
+        left join sample_plates as sp on sp.plate_id = sw.plate_id;
         """
     sample_wells = pd.read_sql(sql, cxn)
     return sample_wells
@@ -65,21 +66,12 @@ def get_plate_wells(sample_wells):
 def get_genus_coverage(cxn):
     """Get family and genus coverage."""
     sql = """
-          WITH in_images AS (
-            SELECT sci_name
-              FROM taxonomy
-             WHERE sample_id_1 IN (SELECT sample_id FROM images)
-                OR sample_id_2 IN (SELECT sample_id FROM images)
-                OR sample_id_3 IN (SELECT sample_id FROM images)
-                OR sample_id_4 IN (SELECT sample_id FROM images)
-                OR sample_id_5 IN (SELECT sample_id FROM images))
-        SELECT family, genus, sci_name AS total, 1 AS imaged
+        SELECT family, genus, sci_name AS total,
+               COUNT(im.sample_id) > 0 AS imaged
           FROM taxonomy
-         WHERE sci_name IN (SELECT sci_name FROM in_images)
-     UNION ALL
-        SELECT family, genus, sci_name AS total, 0 AS imaged
-          FROM taxonomy
-         WHERE sci_name NOT IN (SELECT sci_name FROM in_images);
+     LEFT JOIN taxonomy_ids AS ti USING (sci_name)
+     LEFT JOIN images AS im USING (sample_id)
+      GROUP BY taxonomy.rowid;
     """
     taxonomy = pd.read_sql(sql, cxn)
 
@@ -34,6 +34,7 @@ from datetime import datetime
 import pandas as pd
 from jinja2 import Environment, FileSystemLoader
 import lib.db as db
+import lib.plates as plates
 import lib.util as util
 
 
@@ -60,102 +61,114 @@ def select_samples():
 
     taxonomy_errors = get_taxonomy_errors(cxn)
     families = get_families(cxn)
-    get_genera(cxn, families)
-    sample_groups = get_sampled_species(cxn, taxonomy_errors)
+    genera = get_genera(cxn, families)
+    samples = get_sampled_species(cxn, taxonomy_errors, genera)
 
-    for (family_name, genus_name), samples in sample_groups:
-        family = families[family_name]
-        genus = family['genera'][genus_name]
+    apply_rules(samples, taxonomy_errors)
 
-        apply_rules_to_genus(samples, genus, taxonomy_errors)
+    genus_totals = sum_genus_totals(samples)
+    put_samples_in_genera(samples, families, genus_totals)
 
-        sum_genus_totals(samples, genus)
-        put_samples_in_genus(samples, genus)
-
-    sum_family_totals(families)
-    totals = sum_grand_totals(families)
+    family_totals = sum_family_totals(families, genera, genus_totals)
+    totals = sum_grand_totals(family_totals)
 
     output_html(families, totals)
     output_csv(families)
 
 
-def apply_rules_to_genus(samples, genus, taxonomy_errors):
-    """Update the samples according to the rules."""
+def apply_rules(samples, taxonomy_errors):
+    """
+    Update the samples according to the rules.
+
+    Each rule runs once over every sample. The genus level data each rule
+    needs, the priority and the slots, is already joined to the samples.
+    """
     rule_mark_already_sequenced(samples)
     rule_mark_unprocessed(samples)
     rule_mark_available(samples)
     rule_reject_too_many_sci_names(samples, taxonomy_errors)
     rule_reject_total_dna_too_low(samples)
-    rule_select_all_out_groups(samples, genus)
-    # rule_reject_low_priority(samples, genus)
-    rule_select_high_priority_taxa(samples, genus)
-    rule_select_by_genus_count(samples, genus)
+    rule_select_all_out_groups(samples)
+    # rule_reject_low_priority(samples)
+    rule_select_high_priority_taxa(samples)
+    rule_select_by_genus_count(samples)
+
+
+def has_status(samples, status):
+    """Find the samples with the status, None is for no status yet."""
+    return samples.status_value == (status.value if status else 0)
+
+
+def set_status(samples, where, status):
+    """Set the status of the samples."""
+    samples.loc[where, 'status_value'] = status.value
 
 
 def rule_mark_already_sequenced(samples):
     """Identify samples sequenced by Rapid."""
-    samples.loc[samples.seq_returned != 0, 'status'] = Status.sequenced
+    set_status(samples, samples.seq_returned != 0, Status.sequenced)
 
 
 def rule_mark_unprocessed(samples):
     """Identify unprocessed samples."""
-    no_status = samples.status.isna()
+    no_status = has_status(samples, None)
     unprocessed = samples.source_plate.isna()
-    samples.loc[no_status & unprocessed, 'status'] = Status.unprocessed
+    set_status(samples, no_status & unprocessed, Status.unprocessed)
 
 
 def rule_mark_available(samples):
     """Identify samples that may be selected."""
-    no_status = samples.status.isna()
-    samples.loc[no_status, 'status'] = Status.available
+    set_status(samples, has_status(samples, None), Status.available)
 
 
 def rule_reject_too_many_sci_names(samples, taxonomy_errors):
     """Toss every sample associated with more than one scientific name."""
-    available = samples.status == Status.available
+    available = has_status(samples, Status.available)
     names_err = samples.sample_id.isin(taxonomy_errors)
-    samples.loc[
-        available & names_err, 'status'] = Status.reject_scientific_name
+    set_status(samples, available & names_err, Status.reject_scientific_name)
 
 
 def rule_reject_total_dna_too_low(samples, threshold=10.0):
     """Toss every sample with a total DNA < threshold ng."""
-    available = samples.status == Status.available
+    available = has_status(samples, Status.available)
     too_low = samples.total_dna < threshold
-    samples.loc[available & too_low, 'status'] = Status.reject_yield_too_low
+    set_status(samples, available & too_low, Status.reject_yield_too_low)
 
 
-def rule_select_all_out_groups(samples, genus):
+def rule_select_all_out_groups(samples):
     """All out-groups are high priority."""
-    if ':' in genus['family']:
-        available = samples.status == Status.available
-        samples.loc[available, 'status'] = Status.selected
+    available = has_status(samples, Status.available)
+    out_group = samples.family.str.contains(':', regex=False)
+    set_status(samples, available & out_group, Status.selected)
 
 
-def rule_reject_low_priority(samples, genus):
+def rule_reject_low_priority(samples):
     """Reject low priority genera or ones without a priority."""
-    if genus['priority'] == '':
-        available = samples.status == Status.available
-        samples.loc[available, 'status'] = Status.reject_low_priority
+    available = has_status(samples, Status.available)
+    no_priority = samples.priority == ''
+    set_status(samples, available & no_priority, Status.reject_low_priority)
 
 
-def rule_select_high_priority_taxa(samples, genus):
+def rule_select_high_priority_taxa(samples):
     """Select any sample with a high priority."""
-    if genus['priority'] == 'High':
-        available = samples.status == Status.available
-        samples.loc[available, 'status'] = Status.selected
+    available = has_status(samples, Status.available)
+    high = samples.priority == 'High'
+    set_status(samples, available & high, Status.selected)
 
 
-def rule_select_by_genus_count(samples, genus):
-    """Select samples based on the available slots and available samples."""
-    # if genus['priority'] == 'Medium':
-    end_index = samples.index[0] + genus['slots']
-    slots = samples.index < end_index
-    available = samples.status == Status.available
-    samples.loc[slots & available, 'status'] = Status.selected
+def rule_select_by_genus_count(samples):
+    """
+    Select samples based on the available slots and available samples.
 
-    rejects = samples.index >= end_index
-    samples.loc[rejects & available, 'status'] = Status.reject_genus_count
+    The first samples in each genus, in the order they were queried, fill the
+    genus's slots whatever their status is.
+    """
+    # Medium priority genera would be filtered here
+    position = samples.groupby(['family', 'genus'], sort=False).cumcount()
+    in_slots = position < samples.slots
+    available = has_status(samples, Status.available)
+    set_status(samples, in_slots & available, Status.selected)
+    set_status(samples, ~in_slots & available, Status.reject_genus_count)
 
 
 def get_accumulator_keys():
@@ -164,42 +177,41 @@ def get_accumulator_keys():
     return keys + [status_name for status_name in Status.__members__.keys()]
 
 
-def sum_genus_totals(samples, genus):
-    """Accumulate totals for the genus."""
-    for key in get_accumulator_keys():
-        genus.setdefault(key, 0)
+def sum_genus_totals(samples):
+    """Count each genus's samples by status in one groupby."""
+    counts = pd.DataFrame({
+        'family': samples.family,
+        'genus': samples.genus,
+        'sampled': 1,
+        'sent_for_qc': samples.source_plate.notna().astype(int)})
 
-    genus['sampled'] = samples.shape[0]
-    genus['sent_for_qc'] = samples.source_plate.notna().sum()
     for status_name, status in Status.__members__.items():
-        genus[status_name] = samples.loc[
-            samples.status == status, 'status'].count()
+        counts[status_name] = has_status(samples, status).astype(int)
 
-    rejects = (n for n in Status.__members__.keys() if n.startswith('reject_'))
-    for status_name in rejects:
-        genus['rejected'] += genus[status_name]
+    rejects = [n for n in Status.__members__.keys() if n.startswith('reject_')]
+    counts['rejected'] = counts[rejects].sum(axis='columns')
 
+    return counts.groupby(['family', 'genus']).sum()
 
-def sum_family_totals(families):
+
+def sum_family_totals(families, genera, genus_totals):
     """Accumulate totals."""
     keys = get_accumulator_keys()
-    for family in families.values():
-        for genus in family['genera'].values():
-            for key in keys:
-                family.setdefault(key, 0)
-                family[key] += genus.get(key, 0)
+    genera = genera.set_index(['family', 'genus'])[['species_count', 'slots']]
+    genera = genera.join(genus_totals).fillna(0)
 
+    family_totals = genera.groupby(level='family').sum().astype(int)
+    family_totals = family_totals.reindex(columns=keys, fill_value=0)
+
+    for family_name, row in family_totals.to_dict(orient='index').items():
+        families[family_name].update(row)
+
+    return family_totals
 
-def sum_grand_totals(families):
-    """Accumulate totals."""
-    grand = {}
-    keys = get_accumulator_keys()
-    for family in families.values():
-        for key in keys:
-            grand.setdefault(key, 0)
-            grand[key] += family.get(key, 0)
 
-    return grand
+def sum_grand_totals(family_totals):
+    """Accumulate totals."""
+    return family_totals.sum().to_dict()
 
 
 def get_taxonomy_errors(cxn):
@@ -208,11 +220,21 @@ def get_taxonomy_errors(cxn):
     return taxonomy_errors.set_index('sample_id').sci_name_1.to_dict()
 
 
-def put_samples_in_genus(samples, genus):
-    """Move the samples into the genus dictionary."""
-    samples['status_value'] = samples.status.apply(lambda x: x.value)
-    genus['samples'] = samples.fillna('').sort_values(
-        ['status_value', 'sci_name']).to_dict(orient='records')
+def put_samples_in_genera(samples, families, genus_totals):
+    """Move the samples and their totals into the genus dictionaries."""
+    for (family_name, genus_name), row in genus_totals.to_dict(
+            orient='index').items():
+        families[family_name]['genera'][genus_name].update(row)
+
+    by_value = {s.value: s for s in Status}
+    samples['status'] = samples.status_value.map(by_value)
+    samples = samples.drop(['priority', 'slots'], axis='columns')
+    samples = samples.fillna('').sort_values(
+        ['family', 'genus', 'status_value', 'sci_name'], kind='stable')
+
+    for sample in samples.to_dict(orient='records'):
+        genus = families[sample['family']]['genera'][sample['genus']]
+        genus.setdefault('samples', []).append(sample)
 
 
 def get_families(cxn):
@@ -245,8 +267,10 @@ def get_genera(cxn, families):
         families[family_name]['genera'] = group.set_index('genus').to_dict(
             orient='index', into=OrderedDict)
 
+    return genera
 
-def get_sampled_species(cxn, taxonomy_errors):
+
+def get_sampled_species(cxn, taxonomy_errors, genera):
     """Read from database and format the data for further processing."""
     sql = """
         SELECT family, genus, sci_name,
@@ -254,9 +278,10 @@ def get_sampled_species(cxn, taxonomy_errors):
                sample_wells.sample_id,
                qc.total_dna,
                rt.sample_id is not null as seq_returned,
-               local_no, well, plate_id,
-               NULL as status
+               sp.local_no, well, sample_wells.plate_id,
+               0 as status_value
           FROM sample_wells
+     LEFT JOIN sample_plates          AS sp USING (plate_id)
      LEFT JOIN taxonomy_ids                 USING (sample_id)
      LEFT JOIN taxonomy                     USING (sci_name)
      LEFT JOIN qc_normal_plate_layout AS qc USING (plate_id, well)
@@ -276,7 +301,12 @@ def get_sampled_species(cxn, taxonomy_errors):
 
     species.total_dna = species.total_dna.fillna(0)
 
-    return species.groupby(['family', 'genus'])
+    # Samples without a genus are not reported. Give the others the genus
+    # data the rules need.
+    species = species.dropna(subset=['family', 'genus'])
+    return species.merge(
+        genera[['family', 'genus', 'priority', 'slots']],
+        how='left', on=['family', 'genus'])
 
 
 def calculate_available_slots(count):
@@ -350,19 +380,16 @@ def output_csv(families):
 
     all_samples = pd.concat(all_samples)
 
-    dummies = []
-    for plate in all_samples.Plate.unique():
-        for row in 'ABCDEFGH':
-            for col in range(1, 13):
-                dummies.append({
-                    'Plate': plate,
-                    'Well': f'{row}{col:02d}'})
-    dummies = pd.DataFrame(dummies)
-
-    all_samples = pd.merge_ordered(
-        dummies, all_samples, how='left', on=['Plate', 'Well'])
+    # Add a blank row for every empty well so each plate is complete
+    used = plates.PlateArray(
+        all_samples.Plate.unique(), fill=False, dtype=bool)
+    used.set(all_samples.Plate, all_samples.Well, True)
+    empty = used.to_frame('used')
+    empty = empty.loc[~empty.used, ['plate_id', 'well']].rename(
+        columns={'plate_id': 'Plate', 'well': 'Well'})
 
-    all_samples = all_samples.sort_values(['Plate', 'Well'])
+    all_samples = pd.concat([all_samples, empty], ignore_index=True)
+    all_samples = all_samples.sort_values(['Plate', 'Well'], kind='stable')
     csv_path = util.get_report_data_dir() / 'sample_selection.csv'
     all_samples.to_csv(csv_path, index=False)
 
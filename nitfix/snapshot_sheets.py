@@ -0,0 +1,48 @@
+"""Save or list snapshots of the Google sheets used by the ingest scripts.
+
+Replay a snapshot by running the scripts with the NITFIX_SNAPSHOT
+environment variable set to its name, or with run_pipeline.py --snapshot.
+Nothing is read from Google then so the database can be rebuilt offline
+and the same way every time.
+"""
+
+import argparse
+
+import lib.google as google
+import lib.snapshots as snapshots
+import lib.util as util
+
+
+def save(name=None):
+    """Save a snapshot of every sheet."""
+    name = google.snapshot_sheets(util.ALL_SHEETS, name)
+    print(f'Saved sheet snapshot {name}')
+
+
+def show():
+    """List the snapshots."""
+    for name in snapshots.list_snapshots():
+        print(name)
+
+
+def parse_args():
+    """Process command-line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    save_parser = subparsers.add_parser('save', help="""Save a snapshot.""")
+    save_parser.add_argument(
+        'name', nargs='?',
+        help="""Name the snapshot this. It defaults to the current time.""")
+
+    subparsers.add_parser('list', help="""List the snapshots.""")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    ARGS = parse_args()
+    if ARGS.command == 'save':
+        save(ARGS.name)
+    else:
+        show()
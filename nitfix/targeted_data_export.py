@@ -6,20 +6,15 @@ will be "active" at a time.
 
 import csv
 import os
-import sqlite3
-from os.path import dirname
 
 import pandas as pd
-from PIL import Image
 
 import lib.db as db
+import lib.image_loader as loader
 import lib.util as util
 
 REQUEST_DIR = util.RAW_DATA / 'export_requests'
 
-CXN = db.connect()
-CXN.row_factory = sqlite3.Row
-
 
 def export_images(df: pd.DataFrame, image_dir, factor=0.75):
     """Get the target images."""
@@ -32,23 +27,10 @@ def export_images(df: pd.DataFrame, image_dir, factor=0.75):
         if not image_file:
             missing.append((row['sample_id'], row['sci_name']))
             continue
-        src = util.PHOTOS / image_file
         dst = image_zip_dir / image_file.replace('/', '_')
-        original = Image.open(src)
-        transformed = original.resize((
-            int(original.size[0] * factor),
-            int(original.size[1] * factor)))
-        dir_name = dirname(image_file)
-        if original.size[0] > original.size[1]:
-            if (dir_name.startswith('Tingshuang')
-                and dir_name != 'Tingshuang_US_nitfix_photos') \
-                    or dir_name in (
-                    'MO-DOE-nitfix_visit3', 'NY_DOE-nitfix_visit3',
-                    'NY_DOE-nitfix_visit4', 'NY_DOE-nitfix_visit5'):
-                transformed = transformed.transpose(Image.ROTATE_90)
-            else:
-                transformed = transformed.transpose(Image.ROTATE_270)
-        transformed.save(dst)
+        dst.write_bytes(loader.get_image_jpeg(image_file, factor, rotate=True))
+
+    loader.prune_derived_images()
 
     for image in missing:
         print(image)
@@ -58,7 +40,7 @@ def export_mirbelioids():
     """Export all Merbelioids images and NfN data from a given list in a CSV file."""
     with open(REQUEST_DIR / 'Mirbelioids_Data.csv') as csv_file:
         reader = csv.reader(csv_file)
-        sample_ids = {r[7] for r in reader}
+        sample_ids = {util.normalize_uuid(r[7]) or r[7] for r in reader}
     values = [f"('{s}')" for s in sample_ids]
     values = ','.join(values)
 
@@ -71,7 +53,7 @@ def export_mirbelioids():
      left join nfn_data using (sample_id)
          where sample_id in (select sample_id from targets);
         """
-    df = pd.read_sql(sql, CXN)
+    df = pd.read_sql(sql, db.connect(readonly=True))
     df.to_csv(util.TEMP_DATA / 'Mirbelioids_data_2020-11-16a.csv', index=False)
     export_images(df, 'Mirbelioid_images')
 
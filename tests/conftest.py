@@ -0,0 +1,6 @@
+"""Let the tests import the pipeline's lib package like the scripts do."""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'nitfix'))
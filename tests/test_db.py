@@ -0,0 +1,68 @@
+"""Test replacing tables in the database."""
+
+import sqlite3
+import pandas as pd
+import pytest
+from lib import db
+
+
+@pytest.fixture
+def cxn():
+    """An in-memory database with a table to replace."""
+    cxn = sqlite3.connect(':memory:')
+    cxn.execute('CREATE TABLE things (name TEXT)')
+    cxn.execute('CREATE TABLE other (name TEXT)')
+    cxn.execute("INSERT INTO things VALUES ('old')")
+    cxn.commit()
+    yield cxn
+    cxn.close()
+
+
+def names(cxn, table):
+    """Get the names in a table."""
+    return [r[0] for r in cxn.execute(f'SELECT name FROM {table}')]
+
+
+def test_load_table_replaces_rows(cxn):
+    """The new rows replace the old ones."""
+    db.load_table(cxn, 'things', pd.DataFrame({'name': ['new']}))
+    assert not cxn.in_transaction
+    assert names(cxn, 'things') == ['new']
+
+
+def test_swap_leaves_callers_transaction_open(cxn):
+    """The swap joins the caller's transaction and doesn't commit it."""
+    cxn.execute("INSERT INTO other VALUES ('pending')")
+    db.load_table(cxn, 'things', pd.DataFrame({'name': ['new']}))
+
+    assert cxn.in_transaction
+    cxn.rollback()
+    assert names(cxn, 'other') == []
+    assert names(cxn, 'things') == ['old']
+
+
+def test_failed_swap_keeps_callers_writes(cxn):
+    """A failed swap only undoes itself."""
+    cxn.execute("INSERT INTO other VALUES ('pending')")
+
+    def fill(staging):
+        cxn.execute(f'CREATE TABLE "{staging}" (name TEXT)')
+        raise ValueError('bad data')
+
+    with pytest.raises(ValueError):
+        db.swap_table(cxn, 'things', fill)
+
+    assert cxn.in_transaction
+    cxn.commit()
+    assert names(cxn, 'other') == ['pending']
+    assert names(cxn, 'things') == ['old']
+
+
+def test_old_unique_index_is_not_rebuilt(cxn):
+    """New data can break an old unique index nobody asked for."""
+    cxn.execute('CREATE UNIQUE INDEX things_name ON things (name)')
+    cxn.commit()
+
+    db.load_table(cxn, 'things', pd.DataFrame({'name': ['a', 'a']}))
+
+    assert names(cxn, 'things') == ['a', 'a']
@@ -0,0 +1,82 @@
+"""Test matching Rapid plate rows to sample plate rows."""
+
+import uuid
+import pandas as pd
+from lib import normal_plate_layout as layout
+
+COLS = range(1, 13)
+
+
+def sample_ids(count, seed):
+    """Make repeatable sample IDs."""
+    return [str(uuid.UUID(int=seed * 1000 + i)) for i in range(count)]
+
+
+def sample_wells(rows):
+    """Build sample plate wells from (plate_id, row, sample IDs) tuples."""
+    return pd.DataFrame([
+        {'plate_id': plate_id, 'row': row, 'col': col,
+         'well': f'{row}{col:02d}', 'sample_id': sample_id}
+        for plate_id, row, ids in rows
+        for col, sample_id in zip(COLS, ids)])
+
+
+def rapid_wells(rows):
+    """Build Rapid wells from (source_plate, source_row, sample IDs)."""
+    wells = pd.DataFrame([
+        {'source_plate': plate, 'source_row': row, 'source_col': col,
+         'sample_id': sample_id, 'valid_uuid': True}
+        for plate, row, ids in rows
+        for col, sample_id in zip(COLS, ids)])
+    return wells
+
+
+def place(rapid, samples):
+    """Run the heuristics on every Rapid well."""
+    unplaced = pd.Series(True, index=rapid.index)
+    return layout.plate_id_heuristics(rapid, samples, unplaced)
+
+
+def test_exact_row():
+    """A Rapid row with the same sample IDs gets the sample row's wells."""
+    ids = sample_ids(12, 1)
+    samples = sample_wells([('plate1', 'A', ids), ('plate1', 'B', ids)])
+    rapid = rapid_wells([('P1', 'C', ids[::-1])])
+
+    found = place(rapid, samples)
+
+    assert found.plate_id.eq('plate1').all()
+    assert sorted(found.well) == [f'B{c:02d}' for c in COLS]
+
+
+def test_partial_row():
+    """A Rapid row with a bad well is aligned with the closest sample row."""
+    ids = sample_ids(12, 2)
+    other = sample_ids(12, 3)
+    samples = sample_wells([('plate1', 'A', ids), ('plate2', 'A', other)])
+    bad = ids[:5] + sample_ids(1, 4) + ids[6:]
+    rapid = rapid_wells([('P1', 'A', bad)])
+
+    found = place(rapid, samples)
+
+    assert found.plate_id.isna().sum() == 1
+    assert pd.isna(found.plate_id.iloc[5])
+    assert found.plate_id.dropna().eq('plate1').all()
+    assert found.well.dropna().tolist() == [
+        f'A{c:02d}' for c in COLS if c != 6]
+
+
+def test_exact_rows_claim_wells_first():
+    """An aligned row can't take the wells of an exactly matching row."""
+    ids = sample_ids(12, 5)
+    samples = sample_wells([('plate1', 'A', ids), ('plate2', 'A', ids)])
+    bad = ids[:5] + sample_ids(1, 6) + ids[6:]
+    rapid = rapid_wells([('P1', 'A', bad), ('P2', 'A', ids)])
+
+    found = place(rapid, samples)
+    exact = found.iloc[12:]
+
+    assert exact.plate_id.notna().all()
+    assert sorted(exact.well) == [f'A{c:02d}' for c in COLS]
+    assert not set(found.iloc[:12].dropna().itertuples(index=False)) \
+        & set(exact.itertuples(index=False))
@@ -0,0 +1,36 @@
+"""Test how the pipeline decides which steps are stale."""
+
+from lib import pipeline
+
+
+def test_file_print_sees_middle_edits(tmp_path):
+    """An edit that keeps the file's size, head, and tail is still seen."""
+    path = tmp_path / 'data.csv'
+    data = bytearray(b'x' * 2**20)
+    path.write_bytes(data)
+    before = pipeline.file_print(path)
+
+    data[2**19] = ord('y')
+    path.write_bytes(data)
+
+    assert pipeline.file_print(path) != before
+
+
+def test_file_print_is_stable(tmp_path):
+    """The same contents give the same fingerprint."""
+    path = tmp_path / 'data.csv'
+    path.write_bytes(b'a,b\n1,2\n')
+    assert pipeline.file_print(path) == pipeline.file_print(path)
+
+
+def test_file_print_missing(tmp_path):
+    """A missing file has its own fingerprint."""
+    assert pipeline.file_print(tmp_path / 'nope.csv').endswith('missing')
+
+
+def test_lib_imports_follow_lib_modules(tmp_path):
+    """A script's fingerprint covers the lib modules it uses indirectly."""
+    script = tmp_path / 'script.py'
+    script.write_text('import lib.sci_names as sci_names\n')
+    names = {p.name for p in pipeline.lib_imports(script)}
+    assert {'sci_names.py', 'db.py', 'util.py'} <= names
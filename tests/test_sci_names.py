@@ -0,0 +1,138 @@
+"""Test matching scientific names to the taxonomy."""
+
+import random
+import pandas as pd
+import pytest
+from lib import sci_names
+
+TAXA = [
+    'Astragalus canadensis',
+    'Astragalus canariensis',
+    'Acacia dealbata',
+    'Acacia dealbata subsp. subalpina',
+    'Lupinus albus var. graecus',
+    'Mimosa pudica',
+]
+
+
+def levenshtein(pattern, text):
+    """The textbook dynamic programming edit distance."""
+    prev = list(range(len(text) + 1))
+    for i, char in enumerate(pattern, 1):
+        curr = [i]
+        for j, other in enumerate(text, 1):
+            curr.append(min(
+                prev[j] + 1, curr[j - 1] + 1, prev[j - 1] + (char != other)))
+        prev = curr
+    return prev[-1]
+
+
+def distance(pattern, text):
+    """Run the bit-parallel edit distance on two strings."""
+    masks = sci_names.bit_pattern(pattern)
+    return sci_names.edit_distance(masks, len(pattern), text)
+
+
+@pytest.fixture(scope='module')
+def synonyms():
+    """A synonym index for the test taxa."""
+    names = pd.Series(TAXA)
+    return pd.DataFrame({
+        'name_key': sci_names.normalize_names(names),
+        'name': names,
+        'sci_name': names,
+        'is_synonym': 0})
+
+
+def best(names, synonyms):
+    """Get the best match for each name."""
+    return sci_names.best_matches(pd.Series(names), synonyms=synonyms)
+
+
+@pytest.mark.parametrize('pattern,text', [
+    ('', ''), ('', 'abc'), ('abc', ''), ('kitten', 'sitting'),
+    ('flaw', 'lawn'), ('abc', 'abc'), ('a' * 70, 'a' * 68 + 'bb')])
+def test_edit_distance_examples(pattern, text):
+    """Match the reference distance on edge cases and long patterns."""
+    assert distance(pattern, text) == levenshtein(pattern, text)
+
+
+def test_edit_distance_random():
+    """Match the reference distance on random strings."""
+    rng = random.Random(42)
+    for _ in range(500):
+        pattern = ''.join(rng.choices('abcd ', k=rng.randint(0, 80)))
+        text = ''.join(rng.choices('abcd ', k=rng.randint(0, 80)))
+        assert distance(pattern, text) == levenshtein(pattern, text)
+
+
+def test_ngram_candidates_keep_real_matches():
+    """The n-gram filter never drops a name that is close enough."""
+    rng = random.Random(7)
+    keys = [''.join(rng.choices('abcdefgh', k=rng.randint(8, 30)))
+            for _ in range(300)]
+    synonyms = pd.DataFrame({'name': keys, 'sci_name': keys, 'is_synonym': 0})
+    index = sci_names.NameIndex(synonyms)
+
+    for key in keys[:50]:
+        key = key[:3] + 'x' + key[4:]
+        found = set(index.gram_candidates(key, sci_names.MIN_SCORE))
+        for i, text in enumerate(index.keys):
+            score = 1.0 - levenshtein(key, text) / max(len(key), len(text))
+            if score >= sci_names.MIN_SCORE:
+                assert i in found
+
+
+def test_exact_and_authority(synonyms):
+    """Case, spacing, and authorities don't stop an exact match."""
+    found = best(['acacia  dealbata Link', 'Mimosa_pudica L.'], synonyms)
+    assert found.sci_name.tolist() == ['Acacia dealbata', 'Mimosa pudica']
+    assert found.score.tolist() == [1.0, 1.0]
+
+
+def test_misspelled_epithet(synonyms):
+    """A misspelled epithet matches a name in the same genus."""
+    found = best(['Astragalus canadensys'], synonyms)
+    assert found.sci_name[0] == 'Astragalus canadensis'
+    assert 0.9 <= found.score[0] < 1.0
+
+
+def test_genus_does_not_inflate_scores(synonyms):
+    """Different species in one genus are scored on their epithets."""
+    index = sci_names.NameIndex(synonyms)
+    hits = index.fuzzy_match('astragalus canadensis', sci_names.MIN_SCORE)
+    names = {index.targets.at[t, 'sci_name'] for t, _ in hits}
+    assert 'Astragalus canariensis' not in names
+
+
+def test_misspelled_genus(synonyms):
+    """A genus that isn't in the taxonomy falls back to n-grams."""
+    found = best(['Astragallus canadensis'], synonyms)
+    assert found.sci_name[0] == 'Astragalus canadensis'
+
+
+def test_no_match(synonyms):
+    """Names that aren't close to anything get NaN."""
+    found = best(['Mimosa pigra', 'Quercus alba'], synonyms)
+    assert found.sci_name.isna().all()
+    assert found.score.isna().all()
+
+
+def test_infraspecific_names(synonyms):
+    """Infraspecific names match when the ranks agree."""
+    found = best([
+        'Acacia dealbata ssp. subalpina Tindale',
+        'Acacia dealbata subsp. subalpna',
+        'Lupinus albus var graecas'], synonyms)
+    assert found.sci_name.tolist() == [
+        'Acacia dealbata subsp. subalpina',
+        'Acacia dealbata subsp. subalpina',
+        'Lupinus albus var. graecus']
+
+
+def test_infraspecific_names_need_the_same_rank(synonyms):
+    """A variety doesn't fall back to its species or another rank."""
+    found = best([
+        'Mimosa pudica var. unijuga',
+        'Lupinus albus subsp. graecus'], synonyms)
+    assert found.sci_name.isna().all()